@@ -1,5 +1,8 @@
+import os
+import sys
 import json
-import requests
+import mmap
+import struct
 import re
 
 class NoSuchAirport(Exception):
@@ -8,22 +11,159 @@ class NoSuchAirport(Exception):
 class NoData(Exception):
     pass
 
+class StaleDatabase(Exception):
+    pass
+
+# Compiled airport database:
+#   header
+#   ICAO index: sorted fixed-width records (key, data offset, data length)
+#   IATA index: same layout, keyed by IATA code
+#   data: compact JSON of each airport
+MAGIC = b'LEDOAPT1'
+HEADER = struct.Struct('<8sqQIIIIQQQ')
+ENTRY = struct.Struct('<II')
+
+def build_db(src='airports.json', dst='airports.db'):
+    with open(src, 'rb') as f:
+        airports = json.loads(f.read().decode('utf-8'))
+    st = os.stat(src)
+
+    data = bytearray()
+    icao = []
+    iata = {}
+    for code, airport in airports.items():
+        blob = json.dumps(airport, separators=(',', ':')).encode('utf-8')
+        entry = (len(data), len(blob))
+        data += blob
+        icao.append((code.encode('utf-8'), entry))
+        # First airport wins on duplicate IATA, like the linear scan did
+        if airport.get('iata') and not airport['iata'] in iata:
+            iata[airport['iata']] = entry
+    iata = [(code.encode('utf-8'), entry) for code, entry in iata.items()]
+    icao.sort()
+    iata.sort()
+
+    icao_width = max([len(k) for k, _ in icao] + [1])
+    iata_width = max([len(k) for k, _ in iata] + [1])
+
+    def pack_index(entries, width):
+        return b''.join(k.ljust(width, b'\0') + ENTRY.pack(*e) for k, e in entries)
+
+    icao_index = pack_index(icao, icao_width)
+    iata_index = pack_index(iata, iata_width)
+    icao_off = HEADER.size
+    iata_off = icao_off + len(icao_index)
+    data_off = iata_off + len(iata_index)
+    header = HEADER.pack(MAGIC, st.st_mtime_ns, st.st_size, len(icao), icao_width, len(iata), iata_width,
+            icao_off, iata_off, data_off)
+
+    # Write aside and rename so readers never map a half written file
+    tmp = '%s.tmp' % dst
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(icao_index)
+        f.write(iata_index)
+        f.write(data)
+    os.replace(tmp, dst)
+
+class AirportDB(object):
+    # Read-only view of a compiled database. Pages are shared between
+    # processes through the page cache, nothing is parsed up front.
+    def __init__(self, path, src=None):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            self.close()
+            raise StaleDatabase('Truncated %s' % path)
+        (magic, mtime, size, self._icao_count, self._icao_width, self._iata_count, self._iata_width,
+                self._icao_off, self._iata_off, self._data_off) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise StaleDatabase('Not an airport database %s' % path)
+
+        if src and os.path.exists(src):
+            st = os.stat(src)
+            if st.st_mtime_ns != mtime or st.st_size != size:
+                self.close()
+                raise StaleDatabase('%s is older than %s' % (path, src))
+
+    def _find(self, key, offset, count, width):
+        key = key.encode('utf-8')
+        if len(key) > width:
+            return None
+        key = key.ljust(width, b'\0')
+        recsize = width + ENTRY.size
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = offset + mid * recsize
+            cur = self._mm[pos:pos + width]
+            if cur < key:
+                lo = mid + 1
+            elif cur > key:
+                hi = mid
+            else:
+                start, length = ENTRY.unpack_from(self._mm, pos + width)
+                start += self._data_off
+                return json.loads(self._mm[start:start + length].decode('utf-8'))
+        return None
+
+    def get(self, icao):
+        return self._find(icao, self._icao_off, self._icao_count, self._icao_width)
+
+    def get_by_iata(self, iata):
+        return self._find(iata, self._iata_off, self._iata_count, self._iata_width)
+
+    def close(self):
+        self._mm.close()
+
 class Airports(object):
-    def __init__(self):
-        self._airports = {}
-        self.load_airports()
+    def __init__(self, path='airports.json', dbpath='airports.db'):
+        self._path = path
+        self._dbpath = dbpath
+        # Opened on first lookup
+        self._db = None
+        self._airports = None
 
     def load_airports(self):
-        with open('airports.json', 'r') as f:
+        # Compiled database when up to date, airports.json otherwise
+        if os.path.exists(self._dbpath):
+            try:
+                self._db = AirportDB(self._dbpath, src=self._path)
+                return
+            except (StaleDatabase, OSError, ValueError):
+                pass
+
+        with open(self._path, 'r') as f:
             self._airports = json.loads(f.read())
 
+    def _loaded(self):
+        if self._db is None and self._airports is None:
+            self.load_airports()
+
     def get(self, icao):
+        self._loaded()
+        if self._db:
+            airport = self._db.get(icao)
+            if not airport:
+                raise NoSuchAirport
+            return airport
+
         if not icao in self._airports.keys():
             raise NoSuchAirport
 
         return self._airports[icao]
 
     def get_by_iata(self, iata):
+        self._loaded()
+        if self._db:
+            airport = self._db.get_by_iata(iata)
+            if not airport:
+                raise NoSuchAirport
+            return airport
+
         for _, airport in self._airports.items():
             if not airport['iata']:
                 continue
@@ -36,11 +176,13 @@ class Airports(object):
 
 
 class Metar(object):
-    def __init__(self):
+    def __init__(self, airports=None):
         self._baseurl = 'https://tgftp.nws.noaa.gov/data/observations/metar/stations/{}.TXT'
         self._rex_icao = re.compile('^[A-Z0-9]{4}$')
         self._rex_iata = re.compile('^[A-Z]{3}$')
-        self._airports = Airports()
+        if not airports:
+            airports = Airports()
+        self._airports = airports
 
 
 
@@ -58,6 +200,7 @@ class Metar(object):
         else:
             raise NoData
 
+        import requests
         req = requests.get(self._baseurl.format(icao))
 
         if req.status_code == 200:
@@ -69,3 +212,11 @@ class Metar(object):
         else:
             raise NoData
 
+
+if __name__ == '__main__':
+    # python3 airport.py [airports.json [airports.db]]
+    args = sys.argv[1:]
+    src = len(args) > 0 and args[0] or 'airports.json'
+    dst = len(args) > 1 and args[1] or 'airports.db'
+    build_db(src, dst)
+    print('Compiled %s to %s' % (src, dst))
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, 'bench')
+
+if not ROOT in sys.path:
+    sys.path.insert(0, ROOT)
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_port(port, timeout=15):
+    until = time.time() + timeout
+    while time.time() < until:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Nothing listening on port %d' % port)
+
+def make_workdir(config):
+    # Scripts read config.json from working directory
+    workdir = tempfile.mkdtemp(prefix='ledobench-')
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        f.write(json.dumps(config, indent=4))
+    return workdir
+
+def spawn(script, args=(), cwd=None):
+    cmd = [sys.executable, os.path.join(ROOT, script)] + [str(a) for a in args]
+    return subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def stop(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def get_json(url):
+    with urllib.request.urlopen(url) as res:
+        return json.loads(res.read().decode('utf-8'))
+
+def post_json(url, data):
+    req = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as res:
+        return json.loads(res.read().decode('utf-8'))
+
+class ProcStats(object):
+    # CPU seconds and peak RSS of a child process, read from /proc
+    def __init__(self, proc):
+        self._pid = proc.pid
+        self._tick = os.sysconf('SC_CLK_TCK')
+        self._cpu0 = self.cpu()
+        self._t0 = time.time()
+        self.peak_rss = 0
+
+    def cpu(self):
+        try:
+            with open('/proc/%d/stat' % self._pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._tick
+        except (OSError, IndexError):
+            return 0.0
+
+    def rss(self):
+        try:
+            with open('/proc/%d/status' % self._pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.rss())
+
+    def summary(self):
+        self.sample()
+        elapsed = time.time() - self._t0
+        used = self.cpu() - self._cpu0
+        return {'cpu_s': used, 'cpu_pct': 100 * used / elapsed if elapsed else 0, 'rss_mb': self.peak_rss / 1048576}
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for ledoproxy serving a synthetic flight board with scripted
+# status changes. GET /_changes lists when each change became visible.
+
+import sys
+import json
+import time
+import random
+import datetime
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def fmt_time(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def make_flight(fltnr, sdt, arrival=False, codes=()):
+    flight = {
+            'fltnr': fltnr,
+            'sdate': sdt.strftime('%Y%m%d'),
+            'sdt': fmt_time(sdt),
+            'arrival': arrival,
+            'h_apt': 'HEL',
+            'route_1': 'ARN',
+            'route_2': '',
+            'actype': 'A320',
+            'acreg': 'OHLXA',
+            'aircraft': 'A320',
+            'gate': '',
+            'park': '',
+            'prm': '',
+            'prt': '',
+            'est_d': '',
+            'act_d': '',
+            'bltarea': '',
+            'chkarea': '',
+            'chkdsk_1': '',
+            'chkdsk_2': ''
+    }
+    for i in range(6):
+        flight['cflight_%d' % (i + 1)] = codes[i] if i < len(codes) else ''
+    return flight
+
+def make_script(sdt, start, window, burst, rnd):
+    # Gate, stand and estimate published within a few seconds of each other
+    first = start + rnd.uniform(0, window)
+    est = fmt_time(sdt + datetime.timedelta(minutes=rnd.randint(5, 40)))
+    script = [(first, 'gate', str(rnd.randint(10, 55)))]
+    if burst:
+        script.append((first + rnd.uniform(0, burst), 'park', str(rnd.randint(100, 155))))
+        script.append((first + rnd.uniform(0, burst), 'est_d', est))
+    script.sort()
+    return script
+
+class Board(object):
+    def __init__(self, count, prefix='BX', window=None, burst=0, seed=1):
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        start = time.time()
+        rnd = random.Random(seed)
+        self._flights = {}
+        self._scripts = {}
+        for i in range(count):
+            fltnr = '%s%d' % (prefix, 1000 + i)
+            sdt = now + datetime.timedelta(minutes=60 + i % 600)
+            self._flights[fltnr] = [make_flight(fltnr, sdt)]
+            if window:
+                self._scripts[fltnr] = make_script(sdt, start, window, burst, rnd)
+
+    def fltnrs(self):
+        return list(self._flights.keys())
+
+    def get(self, fltnr):
+        flights = self._flights.get(fltnr)
+        script = self._scripts.get(fltnr)
+        if not flights or not script:
+            return flights
+
+        now = time.time()
+        flight = dict(flights[0])
+        for when, field, value in script:
+            if when > now:
+                break
+            flight[field] = value
+        return [flight] + flights[1:]
+
+    def changes(self):
+        return self._scripts
+
+class Handler(BaseHTTPRequestHandler):
+    board = None
+    lock = threading.Lock()
+    requests = 0
+    # Seconds added to board queries, the real proxy waits for Finavia's API
+    latency = 0
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with Handler.lock:
+            Handler.requests += 1
+
+        parts = self.path.strip('/').split('/')
+        if self.latency and parts != ['_changes']:
+            time.sleep(self.latency)
+
+        if parts == ['flights']:
+            self.send_json({'flights': self.board.fltnrs()})
+        elif parts == ['_changes']:
+            self.send_json({'changes': self.board.changes(), 'requests': Handler.requests})
+        elif len(parts) == 2 and parts[0] in ('flight', 'aircraft'):
+            flights = self.board.get(parts[1])
+            if flights:
+                self.send_json({'flights': flights})
+            else:
+                self.send_json({'error': 'No such flight'})
+        else:
+            self.send_json({'error': 'Unknown query'})
+
+def serve(port, board):
+    Handler.board = board
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake ledoproxy')
+    parser.add_argument('--port', type=int, default=8420)
+    parser.add_argument('--flights', type=int, default=1000)
+    parser.add_argument('--prefix', default='BX')
+    parser.add_argument('--window', type=float, default=0, help='Spread first status change of each flight over this many seconds')
+    parser.add_argument('--burst', type=float, default=0, help='Publish further changes within this many seconds of the first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to wait before answering board queries')
+    args = parser.parse_args()
+
+    Handler.latency = args.latency
+
+    board = Board(args.flights, prefix=args.prefix, window=args.window, burst=args.burst, seed=args.seed)
+    server = serve(args.port, board)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
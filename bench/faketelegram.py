@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Minimal Telegram Bot API stand-in. Point telegram.base_url in config.json to
+# http://127.0.0.1:<port>/bot and every API call is answered locally and
+# recorded.
+#
+#   GET  /_calls?since=N   recorded calls (except getUpdates)
+#   POST /_updates         enqueue [{"chat": id, "user": id, "text": "/cmd"}]
+
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class Api(object):
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._calls = []
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+
+    def record(self, method, params):
+        with self._lock:
+            self._calls.append({'t': time.time(), 'method': method, 'params': params})
+
+    def calls(self, since=0):
+        with self._lock:
+            return self._calls[since:]
+
+    def enqueue(self, items):
+        with self._lock:
+            for item in items:
+                self._update_id += 1
+                self._message_id += 1
+                text = item['text']
+                cmdlen = len(text.split(' ')[0])
+                chat = {'id': item['chat'], 'type': item.get('type', 'private')}
+                if chat['type'] != 'private':
+                    chat['title'] = 'bench'
+                self._updates.append({
+                    'update_id': self._update_id,
+                    'message': {
+                        'message_id': self._message_id,
+                        'date': int(time.time()),
+                        'chat': chat,
+                        'from': {'id': item.get('user', item['chat']), 'is_bot': False, 'first_name': 'Bench', 'username': 'bench'},
+                        'text': text,
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': cmdlen}]
+                    }
+                })
+            self._lock.notify_all()
+
+    def get_updates(self, offset, timeout):
+        until = time.time() + min(timeout, 5)
+        with self._lock:
+            while True:
+                updates = [u for u in self._updates if u['update_id'] >= offset]
+                if updates or time.time() >= until:
+                    self._updates = updates
+                    return updates
+                self._lock.wait(until - time.time())
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+class Handler(BaseHTTPRequestHandler):
+    api = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        ctype = self.headers.get('Content-Type', '')
+        if 'json' in ctype and body:
+            return json.loads(body.decode('utf-8'))
+        query = urllib.parse.urlparse(self.path).query
+        params = dict(urllib.parse.parse_qsl(query))
+        params.update(urllib.parse.parse_qsl(body.decode('utf-8')))
+        return params
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/_calls':
+            since = int(dict(urllib.parse.parse_qsl(url.query)).get('since', 0))
+            self.send_json({'calls': self.api.calls(since)})
+        else:
+            self.handle_api()
+
+    def do_POST(self):
+        if self.path == '/_updates':
+            self.api.enqueue(self.read_params())
+            self.send_json({'ok': True})
+        else:
+            self.handle_api()
+
+    def handle_api(self):
+        # /bot<token>/<method>
+        method = urllib.parse.urlparse(self.path).path.rsplit('/', 1)[-1]
+        params = self.read_params()
+
+        if method == 'getUpdates':
+            updates = self.api.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+            self.send_json({'ok': True, 'result': updates})
+            return
+
+        self.api.record(method, params)
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'ledobench', 'username': 'ledobench_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id'))
+            result = {
+                    'message_id': int(params.get('message_id') or self.api.next_message_id()),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': chat_id > 0 and 'private' or 'group'},
+                    'text': params.get('text', '')
+            }
+        else:
+            result = True
+        self.send_json({'ok': True, 'result': result})
+
+def serve(port):
+    Handler.api = Api()
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8443)
+    args = parser.parse_args()
+
+    server = serve(args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark scenarios for tracker.py and bot.py against a fake ledoproxy and
+# a fake Telegram Bot API. Nothing leaves the host.
+#
+#   python3 bench/run.py                     # all scenarios
+#   python3 bench/run.py track-1k burst      # selected scenarios
+#   python3 bench/run.py startup             # spawn to first handled update
+#   python3 bench/run.py --duration 60 --json results.json
+
+import common
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+class Env(object):
+    def __init__(self, flights, window=0, burst=0):
+        self.procs = []
+        self.stats = {}
+        self.proxy_port = common.free_port()
+        self.tg_port = common.free_port()
+        self.tracker_port = common.free_port()
+        self.proxy = 'http://127.0.0.1:%d' % self.proxy_port
+        self.telegram = 'http://127.0.0.1:%d' % self.tg_port
+        self.tracker = 'http://127.0.0.1:%d' % self.tracker_port
+
+        config = {
+                'telegram': {'token': '12345678:benchmark', 'base_url': '%s/bot' % self.telegram},
+                'ledoproxy': {'url': self.proxy},
+                'ledotracker': {'url': self.tracker, 'port': self.tracker_port}
+        }
+        self.workdir = common.make_workdir(config)
+        with open(os.path.join(self.workdir, 'airports.json'), 'w') as f:
+            f.write('{}')
+
+        self.procs.append(common.spawn('bench/fakeproxy.py', [
+            '--port', self.proxy_port, '--flights', flights, '--window', window, '--burst', burst]))
+        self.procs.append(common.spawn('bench/faketelegram.py', ['--port', self.tg_port]))
+        common.wait_port(self.proxy_port)
+        common.wait_port(self.tg_port)
+
+    def start(self, script):
+        proc = common.spawn(script, cwd=self.workdir)
+        self.procs.append(proc)
+        self.stats[script] = common.ProcStats(proc)
+        return proc
+
+    def sample(self, seconds):
+        until = time.time() + seconds
+        while time.time() < until:
+            for stats in self.stats.values():
+                stats.sample()
+            time.sleep(min(1, max(0, until - time.time())))
+
+    def calls(self, method='sendMessage'):
+        calls = common.get_json('%s/_calls' % self.telegram)['calls']
+        return [c for c in calls if c['method'] == method]
+
+    def changes(self):
+        return common.get_json('%s/_changes' % self.proxy)
+
+    def close(self):
+        common.stop(self.procs)
+
+def track_all(env, subs, workers=32):
+    import requests
+    import ledotracker
+    client = ledotracker.TrackerClient(env.tracker)
+
+    def track(sub):
+        # Retry resets a couple of times, anything else counts as failed
+        for attempt in range(3):
+            try:
+                return client.track(*sub)
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.1 * (attempt + 1))
+            except (requests.exceptions.RequestException, ValueError):
+                break
+        return {'status': 'error'}
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(track, subs))
+    elapsed = time.time() - start
+
+    failed = len([r for r in results if r['status'] != 'success'])
+    return len(subs) / elapsed, failed
+
+def first_change(changes, fltnr):
+    script = changes.get(fltnr)
+    return script and script[0][0] or None
+
+def scenario_track(count, duration):
+    # Every flight tracked in its own group chat, status changes spread over the run
+    env = Env(count, window=duration * 0.5, burst=5)
+    try:
+        env.start('tracker.py')
+        common.wait_port(env.tracker_port)
+
+        fltnrs = ['BX%d' % (1000 + i) for i in range(count)]
+        subs = [(f, i + 1, -1000 - i, 'bench') for i, f in enumerate(fltnrs)]
+        rate, failed = track_all(env, subs)
+
+        requests0 = env.changes()['requests']
+        env.sample(duration)
+        proxy = env.changes()
+        polls = (proxy['requests'] - requests0) / duration
+
+        # Latency from first visible change to first message in that chat
+        sent = {}
+        for call in env.calls():
+            chat = int(call['params']['chat_id'])
+            sent.setdefault(chat, call['t'])
+        latencies = []
+        for i, fltnr in enumerate(fltnrs):
+            changed = first_change(proxy['changes'], fltnr)
+            if changed and -1000 - i in sent:
+                latencies.append(sent[-1000 - i] - changed)
+
+        res = {
+                'track_per_s': rate,
+                'track_failed': failed,
+                'polls_per_s': polls,
+                'messages': len(env.calls()),
+                'notified': len(latencies),
+                'latency_p50': common.percentile(latencies, 50),
+                'latency_p95': common.percentile(latencies, 95)
+        }
+        res.update(env.stats['tracker.py'].summary())
+        return res
+    finally:
+        env.close()
+
+def scenario_popular(flights, subscribers, duration):
+    # Few flights with a large audience, each change fans out to every chat
+    env = Env(flights, window=duration * 0.3, burst=5)
+    try:
+        env.start('tracker.py')
+        common.wait_port(env.tracker_port)
+
+        subs = []
+        for i in range(flights):
+            for j in range(subscribers):
+                subs.append(('BX%d' % (1000 + i), j + 1, -1000000 - i * subscribers - j, 'bench'))
+        rate, failed = track_all(env, subs)
+
+        env.sample(duration)
+        proxy = env.changes()
+        calls = env.calls()
+
+        latencies = []
+        for call in calls:
+            chat = int(call['params']['chat_id'])
+            fltnr = 'BX%d' % (1000 + (-1000000 - chat) // subscribers)
+            changed = first_change(proxy['changes'], fltnr)
+            if changed:
+                latencies.append(call['t'] - changed)
+
+        span = calls and calls[-1]['t'] - calls[0]['t'] or 0
+        res = {
+                'track_per_s': rate,
+                'track_failed': failed,
+                'messages': len(calls),
+                'send_per_s': span and len(calls) / span or float('nan'),
+                'latency_p50': common.percentile(latencies, 50),
+                'latency_p95': common.percentile(latencies, 95)
+        }
+        res.update(env.stats['tracker.py'].summary())
+        return res
+    finally:
+        env.close()
+
+def scenario_burst(commands, timeout):
+    # A burst of /flight commands hitting bot.py at once
+    env = Env(1000)
+    try:
+        env.start('bot.py')
+        # Bot is ready when it starts long polling
+        until = time.time() + 30
+        while not env.calls('deleteWebhook') and time.time() < until:
+            time.sleep(0.1)
+        time.sleep(0.5)
+
+        items = [{'chat': 10 + i, 'text': '/flight BX%d' % (1000 + i % 1000)} for i in range(commands)]
+        start = time.time()
+        common.post_json('%s/_updates' % env.telegram, items)
+
+        until = start + timeout
+        while time.time() < until:
+            env.sample(0.5)
+            if len(env.calls()) >= commands:
+                break
+
+        calls = env.calls()
+        latencies = [c['t'] - start for c in calls]
+        elapsed = calls and calls[-1]['t'] - start or float('nan')
+        res = {
+                'commands': commands,
+                'replies': len(calls),
+                'cmd_per_s': len(calls) / elapsed,
+                'latency_p50': common.percentile(latencies, 50),
+                'latency_p95': common.percentile(latencies, 95)
+        }
+        res.update(env.stats['bot.py'].summary())
+        return res
+    finally:
+        env.close()
+
+def wait_for(check, timeout=30, interval=0.01):
+    until = time.time() + timeout
+    while time.time() < until:
+        try:
+            if check():
+                return True
+        except OSError:
+            pass
+        time.sleep(interval)
+    return False
+
+def scenario_startup(rounds):
+    # Process spawn to first handled update (bot.py) or first answered request (tracker.py)
+    bot_times = []
+    tracker_times = []
+    for _ in range(rounds):
+        env = Env(10)
+        try:
+            # Queued before start, so the first getUpdates returns it
+            common.post_json('%s/_updates' % env.telegram, [{'chat': 10, 'text': '/start'}])
+            start = time.time()
+            env.start('bot.py')
+            if wait_for(lambda: env.calls()):
+                bot_times.append(env.calls()[0]['t'] - start)
+
+            start = time.time()
+            env.start('tracker.py')
+            if wait_for(lambda: common.get_json('%s/flights' % env.tracker)['status'] == 'success'):
+                tracker_times.append(time.time() - start)
+        finally:
+            env.close()
+
+    res = {
+            'rounds': rounds,
+            'bot_p50': common.percentile(bot_times, 50),
+            'bot_max': max(bot_times or [float('nan')]),
+            'tracker_p50': common.percentile(tracker_times, 50),
+            'tracker_max': max(tracker_times or [float('nan')])
+    }
+    return res
+
+SCENARIOS = {
+        'track-10': lambda args: scenario_track(10, args.duration),
+        'track-1k': lambda args: scenario_track(1000, args.duration),
+        'track-10k': lambda args: scenario_track(10000, args.duration),
+        'popular': lambda args: scenario_popular(5, 500, args.duration),
+        'burst': lambda args: scenario_burst(500, args.duration),
+        'startup': lambda args: scenario_startup(5)
+}
+
+def fmt(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ledobot benchmarks')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS.keys()))
+    parser.add_argument('--duration', type=float, default=90, help='Seconds to observe each scenario')
+    parser.add_argument('--json', help='Write results to file')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenarios:
+        if not name in SCENARIOS:
+            print('Unknown scenario %s' % name)
+            sys.exit(1)
+        print('== %s' % name)
+        results[name] = SCENARIOS[name](args)
+        for key, value in results[name].items():
+            print('   %-14s %s' % (key, fmt(value)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(results, indent=4))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Tracking throughput with 1..N tracker shards behind one TrackerClient.
+#
+#   python3 bench/sharding.py --shards 4 --flights 2000
+
+import common
+import ledotracker
+
+import time
+import argparse
+import requests
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+def run(nshards, nflights, workers, latency):
+    proxy_port = common.free_port()
+    ports = [common.free_port() for _ in range(nshards + 1)]
+    config = {
+            'telegram': {'token': '12345678:benchmark'},
+            'ledoproxy': {'url': 'http://127.0.0.1:%d' % proxy_port},
+            'ledotracker': {'url': 'http://127.0.0.1:%d' % ports[0]}
+    }
+    workdir = common.make_workdir(config)
+
+    procs = [common.spawn('bench/fakeproxy.py', ['--port', proxy_port, '--flights', nflights, '--latency', latency])]
+    procs += [common.spawn('tracker.py', [port], cwd=workdir) for port in ports]
+    try:
+        for port in [proxy_port] + ports:
+            common.wait_port(port)
+
+        urls = ['http://127.0.0.1:%d' % port for port in ports]
+        client = ledotracker.TrackerClient(urls[:nshards])
+        fltnrs = ['BX%d' % (1000 + i) for i in range(nflights)]
+
+        def track(fltnr):
+            # Channel subscriptions do not send anything to Telegram
+            for attempt in range(3):
+                try:
+                    return client.track(fltnr, 1, chan=-1, notify='bench')
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.1 * (attempt + 1))
+                except (requests.exceptions.RequestException, ValueError):
+                    break
+            return {'status': 'error'}
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(track, fltnrs))
+        elapsed = time.time() - start
+
+        failed = len([r for r in results if r['status'] != 'success'])
+        spread = collections.Counter(client.shard_for(f) for f in fltnrs)
+
+        start = time.time()
+        moved = client.add_shard(urls[nshards])
+        rebalance = time.time() - start
+
+        return {
+                'shards': nshards,
+                'rate': nflights / elapsed,
+                'failed': failed,
+                'max_share': max(spread.values()) / nflights,
+                'moved': moved,
+                'rebalance': rebalance
+        }
+    finally:
+        common.stop(procs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracker sharding benchmark')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--flights', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=32)
+    # Each track waits for the proxy like against Finavia, so a shard is
+    # busy with its own requests and the client and fake proxy stay idle
+    parser.add_argument('--latency', type=float, default=0.02, help='Proxy answer delay in seconds')
+    args = parser.parse_args()
+
+    base = None
+    # Efficiency compares scaling to the split of the hash ring, 1.0 is linear
+    print('%-7s %12s %8s %10s %7s %10s %8s %10s' % ('shards', 'flights/s', 'scaling', 'efficiency', 'failed', 'max share', 'moved', 'rebalance'))
+    for nshards in range(1, args.shards + 1):
+        res = run(nshards, args.flights, args.workers, args.latency)
+        if base is None:
+            base = res['rate']
+        print('%-7d %12.1f %7.2fx %10.2f %7d %9.1f%% %8d %9.2fs' % (
+            res['shards'], res['rate'], res['rate'] / base, res['rate'] / base * res['max_share'], res['failed'],
+            res['max_share'] * 100, res['moved'], res['rebalance']))
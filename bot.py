@@ -1,28 +1,68 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from telegram.ext import Updater, CommandHandler
+# telegram.ext and requests are imported only when first needed, keep
+# module level light so the bot can answer its first update quickly
 import ledoproxy
 import airport
 import formatting
 import ledotracker
+import metrics
 
-import re
-import sys
 import json
-import time
-import random
 import datetime
-import requests
+import functools
 
 import traceback
 
 import logging
-logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(name)s %(message)s')
 logger = logging.getLogger('ledobot')
 
-with open('config.json', 'r') as f:
-    config = json.loads(f.read())
+config = None
+
+commands = metrics.Counter('ledo_bot_commands_total', 'Handled bot commands', labels=('command',))
+
+def load_config(path='config.json'):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+class Clients(object):
+    # Built on first use, commands not needing a client never pay for it
+    @functools.cached_property
+    def ledoclient(self):
+        proxyconf = config['ledoproxy']
+        return ledoproxy.ProxyClient(proxyconf['url'], timeout=proxyconf.get('timeout', 10),
+                failures=proxyconf.get('failures', 5), reset=proxyconf.get('reset', 30), cache=proxyconf.get('cache', 1000))
+
+    @functools.cached_property
+    def metar(self):
+        return airport.Metar()
+
+    @functools.cached_property
+    def tracker(self):
+        # List of URLs in 'urls' shards tracked flights over several trackers
+        return ledotracker.TrackerClient(config['ledotracker'].get('urls') or config['ledotracker']['url'])
+
+clients = Clients()
+
+def reply(update, context, text):
+    try:
+        with metrics.stage_seconds.time('send'):
+            context.bot.sendMessage(chat_id=update.message.chat_id, text=text, parse_mode='Markdown')
+        metrics.telegram_sends.inc('sendMessage', 'ok')
+    except:
+        metrics.telegram_sends.inc('sendMessage', 'error')
+        raise
+
+def stale_note(flights):
+    if not isinstance(flights, ledoproxy.StaleFlights):
+        return None
+    fetched = datetime.datetime.fromtimestamp(flights.fetched)
+    return '_Flight data unavailable, showing data from %s_' % fetched.strftime('%d.%m. %H:%M')
+
+def fmt_flight(flight):
+    with metrics.stage_seconds.time('format'):
+        return formatting.FinaviaFormatter(flight).to_text()
 
 def log_msg(update):
     m = update.message
@@ -44,40 +84,43 @@ def log_msg(update):
     prefix = 'msg:%s' % chat
     logger.info(' :: '.join((prefix, sender, text)))
 
-ledoclient = ledoproxy.ProxyClient(config['ledoproxy']['url'])
-airports = airport.Airports()
-metar = airport.Metar()
-tracker = ledotracker.TrackerClient(config['ledotracker']['url'])
-
-updater = Updater(token=config['telegram']['token'])
-dispatcher = updater.dispatcher
-
 class CmdHandler(object):
-    def __init__(self, dispatcher):
+    def __init__(self):
         self._commands = {}
-        self._dispatcher = dispatcher
 
     def cmd(self, func):
         name = func.__name__
         if name.startswith('cmd_'):
             name = name.split('_', 1)[1]
         self._commands[name] = func
-
-        self._dispatcher.add_handler(CommandHandler(name, func, pass_args=True))
         return func
 
+    def register(self, dispatcher):
+        from telegram.ext import CommandHandler
+
+        for name, func in self._commands.items():
+            dispatcher.add_handler(CommandHandler(name, self.wrap(name, func), pass_args=True))
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def handler(update, context):
+            commands.inc(name)
+            with metrics.stage_seconds.time('cmd_%s' % name):
+                return func(update, context)
+        return handler
+
     def get_cmds(self):
         return self._commands.keys()
 
     def get_helps(self):
         return dict((name, func.__doc__) for name, func in self._commands.items() if func.__doc__)
 
-cmdhandler = CmdHandler(dispatcher)
+cmdhandler = CmdHandler()
 
 @cmdhandler.cmd
 def cmd_start(update, context):
     """Start usage.. Does nothing."""
-    context.bot.sendMessage(chat_id=update.message.chat_id, text='You need /help?', parse_mode='Markdown')
+    reply(update, context, 'You need /help?')
 
 
 @cmdhandler.cmd
@@ -105,7 +148,7 @@ def cmd_help(update, context):
     else:
         resp = '??'
 
-    context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+    reply(update, context, resp)
 
 @cmdhandler.cmd
 def cmd_flight(update, context):
@@ -115,17 +158,24 @@ def cmd_flight(update, context):
     try:
         if len(args) == 0:
             resp = 'Which flight?'
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
             return
 
         fltnr = args[0].upper()
         try:
-            for flight in ledoclient.get_flight(fltnr):
-                fmt = formatting.FinaviaFormatter(flight)
-                context.bot.sendMessage(chat_id=update.message.chat_id, text=fmt.to_text(), parse_mode='Markdown')
+            flights = clients.ledoclient.get_flight(fltnr, allow_stale=True)
+            note = stale_note(flights)
+            for flight in flights:
+                resp = fmt_flight(flight)
+                if note:
+                    resp = '%s\n%s' % (note, resp)
+                reply(update, context, resp)
         except ledoproxy.NoFlight:
             resp = 'Flight %s not found' % fltnr
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
+            return
+        except ledoproxy.ConnectionError:
+            reply(update, context, 'Flight information is not available right now')
             return
 
     except:
@@ -137,7 +187,12 @@ def cmd_flights(update, context):
     log_msg(update)
     args = context.args
     try:
-        flights = ledoclient.get_flights()
+        try:
+            flights = clients.ledoclient.get_flights(allow_stale=True)
+        except ledoproxy.ConnectionError:
+            reply(update, context, 'Flight information is not available right now')
+            return
+        note = stale_note(flights)
 
         if len(args) > 0:
             prefix = args[0].upper()
@@ -148,7 +203,10 @@ def cmd_flights(update, context):
         if not flights:
             resp = 'No flights found'
 
-        context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+        if note:
+            resp = '%s\n%s' % (note, resp)
+
+        reply(update, context, resp)
 
     except:
         traceback.print_exc()
@@ -166,11 +224,11 @@ def cmd_metar(update, context):
             code = args[0].upper()
 
             try:
-                resp = metar.get(code)
+                resp = clients.metar.get(code)
             except airport.NoData:
                 resp = '%s not found' % code
 
-        context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+        reply(update, context, resp)
 
     except:
         traceback.print_exc()
@@ -183,18 +241,25 @@ def cmd_aircraft(update, context):
     try:
         if len(args) == 0:
             resp = 'Which aircraft?'
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
             return
 
         aircraft = args[0].upper()
         aircraft = aircraft.replace('-', '')
         try:
-            for flight in ledoclient.get_aircraft(aircraft):
-                fmt = formatting.FinaviaFormatter(flight)
-                context.bot.sendMessage(chat_id=update.message.chat_id, text=fmt.to_text(), parse_mode='Markdown')
+            flights = clients.ledoclient.get_aircraft(aircraft, allow_stale=True)
+            note = stale_note(flights)
+            for flight in flights:
+                resp = fmt_flight(flight)
+                if note:
+                    resp = '%s\n%s' % (note, resp)
+                reply(update, context, resp)
         except ledoproxy.NoFlight:
             resp = 'No flights found'
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
+            return
+        except ledoproxy.ConnectionError:
+            reply(update, context, 'Flight information is not available right now')
             return
 
     except:
@@ -202,16 +267,17 @@ def cmd_aircraft(update, context):
 
 @cmdhandler.cmd
 def cmd_track(update, context):
-    """Track departure and arrival of flight"""
+    """Track departure and arrival of flight, optionally on given date"""
     log_msg(update)
     args = context.args
     try:
         if len(args) == 0:
             resp = 'Which flight?'
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
             return
 
         fltnr = args[0].upper()
+        date = len(args) > 1 and args[1] or None
         chatid = update.message.chat_id
         userdata = update.message.from_user.to_dict()
         if 'username' in userdata.keys():
@@ -220,11 +286,11 @@ def cmd_track(update, context):
             notify = userdata['first_name']
 
         if chatid == userdata['id']:
-            resp = tracker.track(fltnr, chatid)
+            resp = clients.tracker.track(fltnr, chatid, date=date)
         else:
-            resp = tracker.track(fltnr, userdata['id'], chan=chatid, notify=notify)
+            resp = clients.tracker.track(fltnr, userdata['id'], chan=chatid, notify=notify, date=date)
 
-        context.bot.sendMessage(chat_id=update.message.chat_id, text=resp['message'], parse_mode='Markdown')
+        reply(update, context, resp['message'])
 
     except:
         traceback.print_exc()
@@ -237,7 +303,7 @@ def cmd_untrack(update, context):
     try:
         if len(args) == 0:
             resp = 'Which flight?'
-            context.bot.sendMessage(chat_id=update.message.chat_id, text=resp, parse_mode='Markdown')
+            reply(update, context, resp)
             return
 
         fltnr = args[0].upper()
@@ -245,15 +311,77 @@ def cmd_untrack(update, context):
         userdata = update.message.from_user.to_dict()
 
         if chatid == userdata['id']:
-            resp = tracker.untrack(fltnr, chatid)
+            resp = clients.tracker.untrack(fltnr, chatid)
+        else:
+            resp = clients.tracker.untrack(fltnr, userdata['id'], chan=chatid)
+
+        reply(update, context, resp['message'])
+
+    except:
+        traceback.print_exc()
+
+@cmdhandler.cmd
+def cmd_history(update, context):
+    """Show recorded changes of flight"""
+    log_msg(update)
+    args = context.args
+    try:
+        if len(args) == 0:
+            resp = 'Which flight?'
+            reply(update, context, resp)
+            return
+
+        fltnr = args[0].upper()
+        res = clients.tracker.history(fltnr, limit=30)
+        if res['status'] != 'success':
+            resp = res['message']
         else:
-            resp = tracker.untrack(fltnr, userdata['id'], chan=chatid)
+            try:
+                resp = formatting.fmt_history(res['events'])
+            except formatting.NoData:
+                resp = 'No history for %s' % fltnr
+
+        reply(update, context, resp)
 
-        context.bot.sendMessage(chat_id=update.message.chat_id, text=resp['message'], parse_mode='Markdown')
+    except:
+        traceback.print_exc()
+
+@cmdhandler.cmd
+def cmd_delays(update, context):
+    """Average delays per airline or route over last 30 days"""
+    log_msg(update)
+    args = context.args
+    try:
+        by = len(args) > 0 and args[0].lower() or 'airline'
+        res = clients.tracker.delays(by=by)
+        if res['status'] != 'success':
+            reply(update, context, res['message'])
+            return
+
+        delays = sorted(res['delays'], key=lambda d: d[2] / d[1], reverse=True)
+        rows = ['%s: %+d min (%d flights)' % (group, round(total / count / 60), count) for group, count, total in delays[:20]]
+        resp = rows and '\n'.join(rows) or 'No delay data'
+        reply(update, context, resp)
 
     except:
         traceback.print_exc()
 
-updater.start_polling()
-updater.idle()
+def main():
+    global config
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(name)s %(message)s')
+    config = load_config()
+
+    if config.get('metrics', {}).get('enabled', False):
+        metrics.enable()
+        metrics.serve(config['metrics'].get('port', 9422))
+
+    from telegram.ext import Updater
+    updater = Updater(token=config['telegram']['token'], base_url=config['telegram'].get('base_url'))
+    cmdhandler.register(updater.dispatcher)
+
+    updater.start_polling()
+    updater.idle()
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,114 @@
+import re
+import bisect
+import zoneinfo
+import datetime
+
+import formatting
+
+GONE = ('Departed', 'Landed', 'Cancelled')
+
+# Dates given by users are days at Finavia's airports
+HOME_TZ = zoneinfo.ZoneInfo('Europe/Helsinki')
+
+class InvalidDate(Exception):
+    pass
+
+_rex_codes = re.compile('^cflight_[0-9]+$')
+
+def leg_key(data):
+    # Physical identity, same for all codeshare numbers. Station tells the
+    # legs of a multi-leg flight apart, they share number and sdate.
+    return '%s/%s/%s/%s' % (data['fltnr'], data['sdate'], data['arrival'] and 'A' or 'D', data.get('h_apt', ''))
+
+class FlightRecord(object):
+    __slots__ = ('data', 'fltnr', 'codes', 'sdate', 'sdt', 'arrival')
+
+    # Flight dict from ledoproxy parsed once for selection
+    def __init__(self, data):
+        self.data = data
+        self.fltnr = data['fltnr']
+        self.codes = frozenset(v for k, v in data.items() if v and _rex_codes.match(k))
+        self.sdate = data['sdate']
+        self.sdt = formatting.parse_time(data['sdt'])
+        self.arrival = bool(data['arrival'])
+
+    def matches(self, code):
+        return code == self.fltnr or code in self.codes
+
+    def is_gone(self):
+        return self.data['prt'] in GONE
+
+    def key(self):
+        return leg_key(self.data)
+
+
+class FlightBoard(object):
+    def __init__(self, flights):
+        records = sorted((FlightRecord(f) for f in flights), key=lambda r: r.sdt)
+        self._deps = [r for r in records if not r.arrival]
+        self._arrs = [r for r in records if r.arrival]
+        self._dep_times = [r.sdt for r in self._deps]
+        self._arr_times = [r.sdt for r in self._arrs]
+
+    def _first(self, records, times, code, since, until):
+        start = since and bisect.bisect_left(times, since) or 0
+        for i in range(start, len(records)):
+            record = records[i]
+            if until is not None and record.sdt >= until:
+                break
+            if record.matches(code) and not record.is_gone():
+                return record
+        return None
+
+    def departure(self, code, since=None, until=None):
+        return self._first(self._deps, self._dep_times, code, since, until)
+
+    def arrival(self, code, since=None, until=None):
+        return self._first(self._arrs, self._arr_times, code, since, until)
+
+
+def parse_date(text, today=None):
+    # 2019-05-24, 24.05.2019 or 24.05.
+    if not today:
+        today = datetime.datetime.now(HOME_TZ).date()
+    text = text.strip()
+    try:
+        if re.match('^[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}$', text):
+            return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+        m = re.match('^([0-9]{1,2})\\.([0-9]{1,2})\\.([0-9]{4})?$', text)
+        if m:
+            year = m.group(3) and int(m.group(3)) or today.year
+            return datetime.date(year, int(m.group(2)), int(m.group(1)))
+    except ValueError:
+        pass
+    raise InvalidDate('Invalid date %s' % text)
+
+
+def select_legs(board, code, now, date=None, horizon=datetime.timedelta(hours=24),
+        turnaround=datetime.timedelta(hours=4), tz=HOME_TZ):
+    """Pick departure and arrival to track for code. Either may be None."""
+    if date:
+        since = datetime.datetime.combine(date, datetime.time(), tzinfo=tz)
+        until = datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time(), tzinfo=tz)
+    else:
+        # Delayed flights may still be waiting past their schedule
+        since = None
+        until = now + horizon
+
+    dep = board.departure(code, since, until)
+    if dep:
+        until = dep.sdt + horizon
+
+    arr = board.arrival(code, since, until)
+
+    # Arrival before departure is either the earlier leg of a multi-leg
+    # flight or an inbound flight with the departure being the next rotation
+    if dep and arr and dep.sdt > arr.sdt:
+        if dep.sdt - arr.sdt > turnaround:
+            dep = None
+
+    return dep, arr
+
+
+def flight_key(dep, arr):
+    return '+'.join(r.key() for r in (dep, arr) if r)
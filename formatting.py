@@ -11,8 +11,10 @@ def parse_time(sdt):
     return utc
 
 class FinaviaFormatter(object):
-    def __init__(self, flight):
+    def __init__(self, flight, code=None):
         self._flight = flight
+        # Codeshare number the reader knows this flight by
+        self._code = code
         self._rex_route = re.compile('^route_[0-9]+$')
         self._rex_codes = re.compile('^cflight_[0-9]+$')
 
@@ -42,6 +44,8 @@ class FinaviaFormatter(object):
 
     def fmt_name(self):
         fltnr = self._flight['fltnr']
+        if self._code and self._code != fltnr:
+            fltnr = '%s (%s)' % (self._code, fltnr)
 
         path = self.build_path()
         fpath = ' - '.join(path)
@@ -179,3 +183,48 @@ class FinaviaFormatter(object):
         resp = '\n'.join(lines)
         return resp
 
+
+
+HISTORY_FIELDS = {
+        'acreg': 'Aircraft',
+        'gate': 'Gate',
+        'park': 'Stand',
+        'prm': 'Status',
+        'est_d': 'Estimated',
+        'act_d': 'Actual',
+        'bltarea': 'Baggage claim'
+}
+
+def fmt_history_value(field, value):
+    if not value:
+        return '-'
+    if field in ('est_d', 'act_d'):
+        try:
+            return parse_time(value).astimezone().strftime('%d.%m. %H:%M')
+        except ValueError:
+            pass
+    return value
+
+def fmt_history(events):
+    # Rows from HistoryStore.timeline grouped by flight leg
+    lines = []
+    leg = None
+    for ts, fltnr, sdate, arrival, apt, field, old, new in events:
+        if not field in HISTORY_FIELDS:
+            continue
+        if (fltnr, sdate, arrival, apt) != leg:
+            leg = (fltnr, sdate, arrival, apt)
+            if lines:
+                lines.append('')
+            title = '%s %s %s' % (fltnr, sdate, arrival and 'arrival' or 'departure')
+            if apt:
+                title = '%s %s' % (title, apt)
+            lines.append('**%s**' % title)
+        when = datetime.datetime.fromtimestamp(ts).strftime('%d.%m. %H:%M')
+        lines.append('%s %s: %s -> %s' % (when, HISTORY_FIELDS[field],
+            fmt_history_value(field, old), fmt_history_value(field, new)))
+
+    if not lines:
+        raise NoData
+
+    return '\n'.join(lines)
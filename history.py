@@ -0,0 +1,152 @@
+import re
+import time
+import sqlite3
+import threading
+
+import formatting
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL NOT NULL,
+    fltnr TEXT NOT NULL,
+    sdate TEXT NOT NULL,
+    arrival INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    old TEXT,
+    new TEXT,
+    apt TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS events_flight ON events (fltnr, ts);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+
+CREATE TABLE IF NOT EXISTS flights (
+    fltnr TEXT NOT NULL,
+    sdate TEXT NOT NULL,
+    arrival INTEGER NOT NULL,
+    apt TEXT NOT NULL DEFAULT '',
+    airline TEXT NOT NULL,
+    route TEXT NOT NULL,
+    sdt INTEGER NOT NULL,
+    act INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (fltnr, sdate, arrival, apt)
+);
+CREATE INDEX IF NOT EXISTS flights_sdt ON flights (sdt);
+
+CREATE TABLE IF NOT EXISTS codes (
+    code TEXT NOT NULL,
+    fltnr TEXT NOT NULL,
+    PRIMARY KEY (code, fltnr)
+);
+'''
+
+# Legs of a multi-leg flight share number, sdate and direction, the
+# station (h_apt) tells them apart. Old rows get an empty station.
+MIGRATE_BEFORE = '''
+ALTER TABLE events ADD COLUMN apt TEXT NOT NULL DEFAULT '';
+DROP INDEX IF EXISTS flights_sdt;
+ALTER TABLE flights RENAME TO flights_old;
+'''
+
+MIGRATE_AFTER = '''
+INSERT INTO flights SELECT fltnr, sdate, arrival, '', airline, route, sdt, act, updated FROM flights_old;
+DROP TABLE flights_old;
+'''
+
+GROUPS = ('airline', 'route')
+
+_rex_airline = re.compile('^([A-Z0-9]{2})')
+
+def _timestamp(value):
+    if not value:
+        return None
+    return int(formatting.parse_time(value).timestamp())
+
+def _text(value):
+    if value is None:
+        return None
+    return str(value)
+
+class HistoryStore(object):
+    def __init__(self, path, retention=180):
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        migrate = self._needs_migration()
+        if migrate:
+            self._db.executescript(MIGRATE_BEFORE)
+        self._db.executescript(SCHEMA)
+        if migrate:
+            self._db.executescript(MIGRATE_AFTER)
+
+    def _needs_migration(self):
+        # Stores written before the station of a leg was recorded
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(events)')]
+        return bool(columns) and not 'apt' in columns
+
+    def record(self, flight, diff, ts=None):
+        # Store field changes from dictdiffer and the latest state of the flight
+        if not ts:
+            ts = time.time()
+
+        fltnr = flight['fltnr']
+        sdate = flight['sdate']
+        arrival = int(bool(flight['arrival']))
+        apt = flight.get('h_apt') or ''
+        events = [(ts, fltnr, sdate, arrival, field, _text(change[0]), _text(change[1]), apt)
+                for ctype, field, change in diff if ctype == 'change' and isinstance(field, str)]
+
+        fmt = formatting.FinaviaFormatter(flight)
+        m = _rex_airline.match(fltnr)
+        summary = (fltnr, sdate, arrival, apt, m and m.group(1) or fltnr, '-'.join(fmt.build_path()),
+                _timestamp(flight['sdt']), _timestamp(flight['act_d']), ts)
+        codes = [(code, fltnr) for code in fmt.get_codes()]
+
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)', events)
+                # Row migrated without station is replaced by the one with it
+                self._db.execute("DELETE FROM flights WHERE fltnr = ? AND sdate = ? AND arrival = ? AND apt = ''",
+                        (fltnr, sdate, arrival))
+                self._db.execute('INSERT OR REPLACE INTO flights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', summary)
+                self._db.executemany('INSERT OR IGNORE INTO codes VALUES (?, ?)', codes)
+
+    def timeline(self, code, since=None, limit=100):
+        # Newest events last, codeshare numbers resolve to operating flight
+        if since is None:
+            since = 0
+        query = '''SELECT ts, fltnr, sdate, arrival, apt, field, old, new FROM events
+                WHERE fltnr IN (SELECT fltnr FROM codes WHERE code = ? UNION SELECT ?) AND ts >= ?
+                ORDER BY ts DESC LIMIT ?'''
+        with self._lock:
+            rows = self._db.execute(query, (code, code, since, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    def delays(self, by='airline', since=None):
+        # Count and total of (actual - scheduled) seconds per group, so
+        # results from several stores can be summed
+        if not by in GROUPS:
+            raise ValueError('Unknown grouping %s' % by)
+        if since is None:
+            since = 0
+        query = '''SELECT %s, COUNT(*), SUM(act - sdt) FROM flights
+                WHERE act IS NOT NULL AND sdt >= ? GROUP BY %s''' % (by, by)
+        with self._lock:
+            return self._db.execute(query, (since,)).fetchall()
+
+    def prune(self, now=None):
+        if not now:
+            now = time.time()
+        cutoff = now - self._retention * 86400
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM events WHERE ts < ?', (cutoff,))
+                self._db.execute('DELETE FROM flights WHERE updated < ?', (cutoff,))
+                self._db.execute('DELETE FROM codes WHERE fltnr NOT IN (SELECT fltnr FROM flights)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
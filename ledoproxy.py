@@ -1,52 +1,138 @@
-import requests
 import json
+import time
+import random
+import threading
+import collections
+
+import metrics
 
 class ConnectionError(Exception):
     pass
 
+class CircuitOpen(ConnectionError):
+    pass
+
 class NoFlight(Exception):
     pass
 
+class StaleFlights(list):
+    # Last known result served while proxy is unreachable
+    def __init__(self, flights, fetched):
+        super().__init__(flights)
+        self.fetched = fetched
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, reset=30, jitter=0.5):
+        self._threshold = threshold
+        self._reset = reset
+        self._jitter = jitter
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0
+        self._probing = False
+
+    def is_open(self):
+        return self._failures >= self._threshold
+
+    def allow(self):
+        with self._lock:
+            if not self.is_open():
+                return True
+            # Half open: let a single probe through once the wait is over
+            if not self._probing and time.time() >= self._retry_at:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.is_open():
+                spread = random.uniform(1 - self._jitter, 1 + self._jitter)
+                self._retry_at = time.time() + self._reset * spread
+
 class ProxyClient(object):
-    def __init__(self, apiurl):
+    def __init__(self, apiurl, timeout=10, failures=5, reset=30, cache=0):
         if apiurl[-1] == '/':
             self._apiurl = apiurl[:-1]
         else:
             self._apiurl = apiurl
+        self._timeout = timeout
+        self._breaker = CircuitBreaker(threshold=failures, reset=reset)
+        # Last good responses per query for stale fallback
+        self._cache_size = cache
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
 
     def _http_request(self, query):
+        if not self._breaker.allow():
+            metrics.proxy_errors.inc('circuit_open')
+            raise CircuitOpen
+
+        # Imported on first request to keep startup light
+        import requests
+
         headers = {}
         url = '%s/%s' % (self._apiurl, query)
+        stage = 'proxy_%s' % query.split('/')[0]
         try:
-            res = requests.get(url, headers=headers)
-            return res.json()
-        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            with metrics.stage_seconds.time(stage):
+                res = requests.get(url, headers=headers, timeout=self._timeout)
+                data = res.json()
+        except (requests.exceptions.RequestException, ValueError):
+            # Any failure must end a half open probe, or the circuit stays open
+            metrics.proxy_errors.inc('connection')
+            self._breaker.failure()
             raise ConnectionError
 
-    def get_flights(self):
-        query = 'flights'
-        res = self._http_request(query)
+        self._breaker.success()
+        return data
 
-        try:
-            return res['flights']
-        except KeyError:
-            raise NoFlight
+    def _store(self, query, flights):
+        if not self._cache_size:
+            return
+        with self._cache_lock:
+            self._cache[query] = (time.time(), flights)
+            self._cache.move_to_end(query)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
-    def get_flight(self, fltnr):
-        query = 'flight/%s' % fltnr
-        res = self._http_request(query)
+    def _query(self, query, allow_stale=False):
+        try:
+            res = self._http_request(query)
+        except ConnectionError:
+            with self._cache_lock:
+                cached = self._cache.get(query)
+            if not allow_stale or not cached:
+                raise
+            fetched, flights = cached
+            return StaleFlights(flights, fetched)
 
         try:
-            return res['flights']
+            flights = res['flights']
         except KeyError:
             raise NoFlight
 
-    def get_aircraft(self, acreg):
-        query = 'aircraft/%s' % acreg
-        res = self._http_request(query)
+        self._store(query, flights)
+        return flights
 
-        try:
-            return res['flights']
-        except KeyError:
-            raise NoFlight
+    def is_available(self):
+        return not self._breaker.is_open()
+
+    def get_flights(self, allow_stale=False):
+        query = 'flights'
+        return self._query(query, allow_stale)
 
+    def get_flight(self, fltnr, allow_stale=False):
+        query = 'flight/%s' % fltnr
+        return self._query(query, allow_stale)
+
+    def get_aircraft(self, acreg, allow_stale=False):
+        query = 'aircraft/%s' % acreg
+        return self._query(query, allow_stale)
@@ -1,25 +1,282 @@
-import requests
 import json
+import time
+import bisect
+import hashlib
+
+from urllib.parse import quote
+
+import logging
+logger = logging.getLogger('ledotracker')
+
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=512):
+        self._replicas = replicas
+        self._keys = []
+        self._ring = {}
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def _hash(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.append(node)
+        for i in range(self._replicas):
+            h = self._hash('%s#%d' % (node, i))
+            self._ring[h] = node
+            bisect.insort(self._keys, h)
+
+    def remove(self, node):
+        if not node in self._nodes:
+            return
+        self._nodes.remove(node)
+        for i in range(self._replicas):
+            h = self._hash('%s#%d' % (node, i))
+            del self._ring[h]
+            del self._keys[bisect.bisect_left(self._keys, h)]
+
+    def get(self, key):
+        if not self._keys:
+            raise KeyError('No nodes in ring')
+        idx = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[self._keys[idx]]
+
+    def nodes(self):
+        return list(self._nodes)
+
 
 class TrackerClient(object):
-    def __init__(self, trackerurl):
-        self._trackerurl = trackerurl
+    def __init__(self, trackerurl, resolve_ttl=3600, token=None):
+        # Single tracker URL or list of tracker shard URLs
+        if isinstance(trackerurl, str):
+            trackerurl = [trackerurl]
+        self._ring = HashRing([u.rstrip('/') for u in trackerurl])
+        # (flight code, date) -> (expires, operating flight number)
+        self._resolved = {}
+        self._resolve_ttl = resolve_ttl
+        # Shared secret for export, import and handoff
+        self._headers = {}
+        if token:
+            self._headers['X-Admin-Token'] = token
 
-    def track(self, fltnr, user, chan=None, notify=None):
+    def _post(self, shard, query, payload):
+        # Imported on first request to keep startup light
+        import requests
+        url = '%s/%s' % (shard, query)
+        headers = dict(self._headers)
+        headers['Content-Type'] = 'application/json'
+        res = requests.post(url, headers=headers, data=json.dumps(payload))
+        return res.json()
+
+    def _get(self, shard, query):
+        import requests
+        url = '%s/%s' % (shard, query)
+        res = requests.get(url, headers=self._headers)
+        return res.json()
+
+    def shard_for(self, fltnr):
+        return self._ring.get(fltnr)
+
+    def resolve(self, fltnr, date=None):
+        # Codeshares must land on the shard polling the operating flight.
+        # Returns operating number and the flight selected while resolving, if any.
+        if len(self.shards()) < 2:
+            return fltnr, None
+        now = time.time()
+        cached = self._resolved.get((fltnr, date))
+        if cached and cached[0] > now:
+            return cached[1], None
+
+        payload = {'fltnr': fltnr}
+        if date:
+            payload['date'] = date
+        import requests
+        try:
+            res = self._post(self.shard_for(fltnr), 'resolve', payload)
+        except (requests.exceptions.RequestException, ValueError):
+            return fltnr, None
+        if res['status'] != 'success':
+            return fltnr, None
+
+        # Drop expired entries now and then, the bot runs for months
+        if len(self._resolved) > 10000:
+            self._resolved = dict((k, v) for k, v in self._resolved.items() if v[0] > now)
+        self._resolved[(fltnr, date)] = (now + self._resolve_ttl, res['fltnr'])
+        return res['fltnr'], res.get('selected')
+
+    def shards(self):
+        return self._ring.nodes()
+
+    def track(self, fltnr, user, chan=None, notify=None, date=None):
         payload = {'fltnr': fltnr, 'user': user}
         if chan and notify:
             payload['chan'] = chan
             payload['notify'] = notify
+        if date:
+            payload['date'] = date
 
-        url = '%s/%s' % (self._trackerurl, 'track')
-        res = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
-        return res.json()
+        owner, selected = self.resolve(fltnr, date)
+        if selected:
+            payload['selected'] = selected
+
+        return self._post(self.shard_for(owner), 'track', payload)
 
     def untrack(self, fltnr, user, chan=None):
         payload = {'fltnr': fltnr, 'user': user}
         if chan:
             payload['chan'] = chan
 
-        url = '%s/%s' % (self._trackerurl, 'untrack')
-        res = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
-        return res.json()
+        owner, _ = self.resolve(fltnr)
+        return self._post(self.shard_for(owner), 'untrack', payload)
+
+    def _gather(self, query):
+        # Ask every shard, skipping those that fail or have history off
+        import requests
+        results = []
+        error = None
+        for shard in self.shards():
+            try:
+                res = self._get(shard, query)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.error('Could not query %s from %s: %s' % (query, shard, e))
+                error = {'status': 'error', 'message': 'History is not available right now'}
+                continue
+            if res['status'] != 'success':
+                error = res
+                continue
+            results.append(res)
+
+        if not results:
+            return None, error
+        return results, None
+
+    def history(self, fltnr, days=30, limit=100):
+        # Shards keep own history, old events may stay on previous owner
+        results, error = self._gather('history/%s?days=%s&limit=%d' % (quote(fltnr, safe=''), days, limit))
+        if error:
+            return error
+
+        events = set()
+        for res in results:
+            events.update(tuple(e) for e in res['events'])
+
+        events = sorted(events)[-limit:]
+        return {'status': 'success', 'events': [list(e) for e in events]}
+
+    def delays(self, by='airline', days=30):
+        results, error = self._gather('delays?by=%s&days=%s' % (quote(by, safe=''), days))
+        if error:
+            return error
+
+        totals = {}
+        for res in results:
+            for group, count, total in res['delays']:
+                c, t = totals.get(group, (0, 0))
+                totals[group] = (c + count, t + total)
+
+        delays = [[group, count, total] for group, (count, total) in totals.items()]
+        return {'status': 'success', 'delays': delays}
+
+    def add_shard(self, url):
+        url = url.rstrip('/')
+        if url in self.shards():
+            return 0
+        old = self.shards()
+        self._ring.add(url)
+        return self.rebalance(old)
+
+    def remove_shard(self, url):
+        url = url.rstrip('/')
+        if not url in self.shards():
+            return 0
+        self._ring.remove(url)
+        return self.rebalance([url] + self.shards())
+
+    def rebalance(self, shards=None):
+        # Move every tracked flight to the shard owning it in the current ring
+        if shards is None:
+            shards = self.shards()
+
+        import requests
+
+        moved = 0
+        for shard in shards:
+            try:
+                res = self._get(shard, 'flights')
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.error('Could not list flights of %s: %s' % (shard, e))
+                continue
+
+            for key, fltnr in res['flights']:
+                owner = self.shard_for(fltnr)
+                if owner == shard:
+                    continue
+                try:
+                    state = self._post(shard, 'export', {'key': key})
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logger.error('Could not export flight %s from %s: %s' % (key, shard, e))
+                    continue
+                if state['status'] != 'success':
+                    continue
+
+                if self._import(owner, state['state']):
+                    moved += 1
+                    continue
+
+                # Export already dropped the flight, give it back to old owner
+                if not self._import(shard, state['state']):
+                    logger.error('Flight %s lost from %s, state: %s' % (key, shard, json.dumps(state['state'])))
+
+        return moved
+
+    def _import(self, shard, state):
+        import requests
+        try:
+            res = self._post(shard, 'import', {'state': state})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error('Could not import flight to %s: %s' % (shard, e))
+            return False
+        if res['status'] != 'success':
+            logger.error('Could not import flight to %s: %s' % (shard, res.get('message')))
+            return False
+        return True
+
+    def handoff(self, shard, url):
+        # Rolling restart: old process pushes its flights to the new one at
+        # url and exits. Ring positions hash from shard URLs, so the new
+        # process has to take over the address of shard afterwards.
+        return self._post(shard.rstrip('/'), 'handoff', {'url': url})
+
+
+if __name__ == '__main__':
+    # Operator commands, shard list is read from ledotracker.urls (or url)
+    # in config.json. Update the config and restart the bot afterwards.
+    #   python3 ledotracker.py add http://host:8423 [...]
+    #   python3 ledotracker.py remove http://host:8422 [...]
+    #   python3 ledotracker.py rebalance
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(name)s %(message)s')
+    args = sys.argv[1:]
+    if not args or not args[0] in ('add', 'remove', 'rebalance'):
+        print('Usage: %s add|remove URL... | rebalance' % sys.argv[0])
+        sys.exit(1)
+
+    with open('config.json', 'r') as f:
+        trackerconf = json.loads(f.read())['ledotracker']
+    client = TrackerClient(trackerconf.get('urls') or trackerconf['url'], token=trackerconf.get('admin_token'))
+
+    moved = 0
+    for url in args[1:]:
+        if args[0] == 'add':
+            moved += client.add_shard(url)
+        elif args[0] == 'remove':
+            moved += client.remove_shard(url)
+    if args[0] == 'rebalance':
+        moved = client.rebalance()
+
+    print('Moved %d flights, shards now: %s' % (moved, ' '.join(client.shards())))
@@ -0,0 +1,169 @@
+import time
+import threading
+
+# Collection is off until enable() is called, so instrumented code only pays
+# for one attribute check per observation.
+enabled = False
+
+_metrics = []
+
+def enable():
+    global enabled
+    enabled = True
+
+def _fmt_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+def _fmt_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self._name = name
+        self._doc = doc
+        self._labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self._name, self._doc), '# TYPE %s %s' % (self._name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append('%s%s %s' % (self._name, _fmt_labels(self._labelnames, labels), _fmt_value(value)))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        super().__init__(name, doc, labels)
+        # Callback gauges are computed at scrape time only
+        self._func = func
+
+    def set(self, value, *labels):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self._func:
+            try:
+                value = self._func()
+            except Exception:
+                value = float('nan')
+            with self._lock:
+                self._values[()] = value
+        return super().render()
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        super().__init__(name, doc, labels)
+        self._buckets = tuple(buckets or self.default_buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        if not enabled:
+            return
+        with self._lock:
+            if not labels in self._values:
+                self._values[labels] = [[0] * len(self._buckets), 0.0, 0]
+            counts, _, _ = entry = self._values[labels]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self._name, self._doc), '# TYPE %s %s' % (self._name, self.kind)]
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self._buckets, counts):
+                cumulative += n
+                lbl = _fmt_labels(self._labelnames, labels, [('le', _fmt_value(bound))])
+                lines.append('%s_bucket%s %d' % (self._name, lbl, cumulative))
+            lbl = _fmt_labels(self._labelnames, labels)
+            lines.append('%s_sum%s %s' % (self._name, lbl, _fmt_value(total)))
+            lines.append('%s_count%s %d' % (self._name, lbl, count))
+        return lines
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        if enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def serve(port, host='0.0.0.0'):
+    # Standalone /metrics endpoint for processes without own HTTP server.
+    # http.server is only imported when scraping is enabled.
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+# Shared metrics of the project
+stage_seconds = Histogram('ledo_stage_seconds', 'Time spent in hot path stages', labels=('stage',))
+proxy_errors = Counter('ledo_proxy_errors_total', 'Failed ledoproxy requests', labels=('kind',))
+telegram_sends = Counter('ledo_telegram_sends_total', 'Telegram API calls', labels=('method', 'result'))
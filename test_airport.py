@@ -0,0 +1,71 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import airport
+
+AIRPORTS = {
+        'EFHK': {'icao': 'EFHK', 'iata': 'HEL', 'name': 'Helsinki-Vantaa'},
+        'EFOU': {'icao': 'EFOU', 'iata': 'OUL', 'name': 'Oulu'},
+        'EFXX': {'icao': 'EFXX', 'iata': '', 'name': 'No IATA code'},
+        'EFHF': {'icao': 'EFHF', 'iata': 'HEL', 'name': 'Helsinki-Malmi'},
+        'KJFK': {'icao': 'KJFK', 'iata': 'JFK', 'name': 'John F Kennedy Intl'}
+}
+
+
+class AirportDBTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.src = os.path.join(self.tmp, 'airports.json')
+        self.dst = os.path.join(self.tmp, 'airports.db')
+        with open(self.src, 'w') as f:
+            f.write(json.dumps(AIRPORTS))
+        airport.build_db(self.src, self.dst)
+
+    def airports(self, db=True):
+        return airport.Airports(self.src, db and self.dst or os.path.join(self.tmp, 'missing.db'))
+
+    def lookup(self, airports, func, code):
+        try:
+            return getattr(airports, func)(code)
+        except airport.NoSuchAirport:
+            return None
+
+    def test_same_as_json(self):
+        compiled = self.airports()
+        plain = self.airports(db=False)
+        for code in list(AIRPORTS.keys()) + ['EFNO', 'E', 'EFHKX']:
+            self.assertEqual(self.lookup(compiled, 'get', code), self.lookup(plain, 'get', code))
+        for code in ('HEL', 'OUL', 'JFK', 'XXX', ''):
+            self.assertEqual(self.lookup(compiled, 'get_by_iata', code), self.lookup(plain, 'get_by_iata', code))
+        self.assertTrue(compiled._db)
+        self.assertFalse(plain._db)
+
+    def test_first_iata_wins(self):
+        self.assertEqual(self.airports().get_by_iata('HEL')['icao'], 'EFHK')
+
+    def test_stale(self):
+        with open(self.src, 'w') as f:
+            f.write(json.dumps(dict(AIRPORTS, EFTP={'icao': 'EFTP', 'iata': 'TMP', 'name': 'Tampere'})))
+        self.assertRaises(airport.StaleDatabase, airport.AirportDB, self.dst, src=self.src)
+
+        # Falls back to airports.json until rebuilt
+        airports = self.airports()
+        self.assertEqual(airports.get('EFTP')['iata'], 'TMP')
+        self.assertFalse(airports._db)
+
+        airport.build_db(self.src, self.dst)
+        self.assertEqual(airport.AirportDB(self.dst, src=self.src).get('EFTP')['iata'], 'TMP')
+
+    def test_not_a_database(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'x' * airport.HEADER.size)
+        self.assertRaises(airport.StaleDatabase, airport.AirportDB, self.dst)
+        self.assertEqual(self.airports().get('EFOU')['iata'], 'OUL')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import datetime
+import unittest
+
+import flights
+
+NOW = datetime.datetime(2019, 5, 24, 8, 0, tzinfo=datetime.timezone.utc)
+H = datetime.timedelta(hours=1)
+
+def make_flight(fltnr, sdt, arrival=False, apt='HEL', prt='', codes=()):
+    flight = {
+            'fltnr': fltnr,
+            'sdate': sdt.strftime('%Y%m%d'),
+            'sdt': sdt.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'arrival': arrival,
+            'h_apt': apt,
+            'prt': prt
+    }
+    for i, code in enumerate(codes):
+        flight['cflight_%d' % (i + 1)] = code
+    return flight
+
+
+class SelectLegsTest(unittest.TestCase):
+    def select(self, data, code, date=None):
+        dep, arr = flights.select_legs(flights.FlightBoard(data), code, NOW, date=date, tz=flights.HOME_TZ)
+        return dep and dep.data, arr and arr.data
+
+    def test_departure_and_arrival(self):
+        dep = make_flight('AY1', NOW + 2 * H)
+        arr = make_flight('AY1', NOW + 5 * H, arrival=True, apt='OUL')
+        self.assertEqual(self.select([arr, dep], 'AY1'), (dep, arr))
+
+    def test_codeshare(self):
+        dep = make_flight('AY1', NOW + 2 * H, codes=['JL5'])
+        self.assertEqual(self.select([dep], 'JL5'), (dep, None))
+        self.assertEqual(self.select([dep], 'JL6'), (None, None))
+
+    def test_gone_skipped(self):
+        gone = make_flight('AY1', NOW - H, prt='Departed')
+        dep = make_flight('AY1', NOW + 20 * H)
+        self.assertEqual(self.select([gone, dep], 'AY1'), (dep, None))
+
+    def test_beyond_horizon(self):
+        dep = make_flight('AY1', NOW + 30 * H)
+        self.assertEqual(self.select([dep], 'AY1'), (None, None))
+
+    def test_multi_leg(self):
+        # HEL-OUL-KTT: first leg departed, track the OUL stop
+        first = make_flight('AY1', NOW - H, prt='Departed')
+        stop = make_flight('AY1', NOW, arrival=True, apt='OUL')
+        second = make_flight('AY1', NOW + H, apt='OUL')
+        self.assertEqual(self.select([first, stop, second], 'AY1'), (second, stop))
+
+    def test_inbound_before_next_rotation(self):
+        arr = make_flight('AY1', NOW + H, arrival=True)
+        dep = make_flight('AY1', NOW + 10 * H)
+        self.assertEqual(self.select([arr, dep], 'AY1'), (None, arr))
+
+    def test_date(self):
+        today = make_flight('AY1', NOW + 2 * H)
+        tomorrow = make_flight('AY1', NOW + 26 * H)
+        date = (NOW + 24 * H).date()
+        self.assertEqual(self.select([today, tomorrow], 'AY1', date=date), (tomorrow, None))
+
+    def test_date_is_helsinki_day(self):
+        # 22:30 UTC on 24th is already 25th in Helsinki
+        late = make_flight('AY1', NOW.replace(hour=22, minute=30))
+        self.assertEqual(self.select([late], 'AY1', date=datetime.date(2019, 5, 25)), (late, None))
+        self.assertEqual(self.select([late], 'AY1', date=datetime.date(2019, 5, 24)), (None, None))
+
+
+class KeyTest(unittest.TestCase):
+    def test_legs_of_multi_leg_flight_differ(self):
+        first = make_flight('AY1', NOW)
+        second = make_flight('AY1', NOW + 2 * H, apt='OUL')
+        self.assertNotEqual(flights.leg_key(first), flights.leg_key(second))
+
+    def test_codeshares_share_key(self):
+        dep = make_flight('AY1', NOW, codes=['JL5'])
+        record = flights.FlightRecord(dep)
+        self.assertEqual(record.key(), flights.leg_key(dep))
+        self.assertEqual(flights.flight_key(record, None), 'AY1/20190524/D/HEL')
+
+
+class ParseDateTest(unittest.TestCase):
+    def test_formats(self):
+        today = datetime.date(2019, 1, 1)
+        self.assertEqual(flights.parse_date('2019-05-24', today), datetime.date(2019, 5, 24))
+        self.assertEqual(flights.parse_date('24.05.2019', today), datetime.date(2019, 5, 24))
+        self.assertEqual(flights.parse_date('24.05.', today), datetime.date(2019, 5, 24))
+
+    def test_invalid(self):
+        for text in ('tomorrow', '31.02.', '2019-13-01'):
+            with self.assertRaises(flights.InvalidDate):
+                flights.parse_date(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
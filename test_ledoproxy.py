@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+
+import requests
+
+import ledoproxy
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('ledoproxy.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = ledoproxy.CircuitBreaker(threshold=2, reset=30, jitter=0)
+
+    def test_opens_after_threshold(self):
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_count(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.is_open())
+
+    def test_single_probe_after_reset(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+        # Others wait while the probe is out
+        self.assertFalse(self.breaker.allow())
+
+    def test_probe_success_closes(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_failure_reopens(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+
+class ProxyClientTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('ledoproxy.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = ledoproxy.ProxyClient('http://proxy/', failures=2, reset=30, cache=10)
+
+    def response(self, data):
+        res = mock.Mock()
+        res.json.return_value = data
+        return res
+
+    def test_any_request_error_ends_probe(self):
+        with mock.patch('requests.get', side_effect=requests.exceptions.ChunkedEncodingError):
+            for _ in range(2):
+                self.assertRaises(ledoproxy.ConnectionError, self.client.get_flights)
+            self.assertRaises(ledoproxy.CircuitOpen, self.client.get_flights)
+            self.now += 60
+            self.assertRaises(ledoproxy.ConnectionError, self.client.get_flights)
+
+        self.now += 60
+        with mock.patch('requests.get', return_value=self.response({'flights': ['AY1']})):
+            self.assertEqual(self.client.get_flights(), ['AY1'])
+        self.assertTrue(self.client.is_available())
+
+    def test_stale_fallback(self):
+        with mock.patch('requests.get', return_value=self.response({'flights': ['AY1']})):
+            self.client.get_flights()
+        with mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError):
+            self.assertRaises(ledoproxy.ConnectionError, self.client.get_flights)
+            flights = self.client.get_flights(allow_stale=True)
+        self.assertIsInstance(flights, ledoproxy.StaleFlights)
+        self.assertEqual(flights, ['AY1'])
+        self.assertEqual(flights.fetched, 1000.0)
+
+    def test_no_flight(self):
+        with mock.patch('requests.get', return_value=self.response({'error': 'No such flight'})):
+            self.assertRaises(ledoproxy.NoFlight, self.client.get_flight, 'AY1')
+
+
+if __name__ == '__main__':
+    unittest.main()
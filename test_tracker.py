@@ -0,0 +1,121 @@
+import datetime
+import unittest
+from unittest import mock
+
+import tracker
+
+SDT = datetime.datetime(2019, 5, 24, 12, 0)
+
+def fmt_time(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def make_flight(**fields):
+    flight = {
+            'fltnr': 'AY1',
+            'sdate': SDT.strftime('%Y%m%d'),
+            'sdt': fmt_time(SDT),
+            'arrival': False,
+            'h_apt': 'HEL',
+            'route_1': 'ARN',
+            'actype': 'A320',
+            'acreg': 'OHLXA',
+            'aircraft': 'A320',
+            'gate': '',
+            'park': '',
+            'prm': '',
+            'prt': '',
+            'est_d': '',
+            'act_d': '',
+            'bltarea': '',
+            'chkarea': '',
+            'chkdsk_1': '',
+            'chkdsk_2': '',
+            'cflight_1': ''
+    }
+    flight.update(fields)
+    return flight
+
+
+class NotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.sent = []
+        patches = [
+                mock.patch('tracker.time.time', lambda: self.now),
+                mock.patch('tracker.send_message', lambda **kwargs: self.sent.append(kwargs)),
+                mock.patch('tracker.coalesce', 0),
+                mock.patch('tracker.live_cards', False),
+                mock.patch('tracker.history_store', None)
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.dep = make_flight()
+        self.flight = tracker.TrackedFlight('AY1/20190524/D/HEL', 'AY1', dep=self.dep, arr=None)
+        self.flight.add_sub(10, None, None, code='AY1')
+        # Drop the initial flight info sent on subscribing
+        del self.sent[:]
+
+    def change(self, **fields):
+        new = dict(self.dep, **fields)
+        diff = [('change', k, (self.dep[k], v)) for k, v in fields.items()]
+        self.flight.notify_change('dep', self.dep, new, diff)
+        self.dep = new
+
+    def test_immediate_without_coalesce(self):
+        self.change(gate='22')
+        self.change(park='123')
+        self.assertEqual(len(self.sent), 2)
+
+    def test_coalesce_burst(self):
+        tracker.coalesce = 10
+        self.change(gate='22')
+        self.now += 3
+        self.change(gate='23', park='123')
+        self.assertEqual(self.sent, [])
+        self.assertFalse(self.flight.needs_flush())
+
+        self.now += 7
+        self.assertTrue(self.flight.needs_flush())
+        self.flight.flush_notifies()
+        self.assertEqual(len(self.sent), 1)
+        text = self.sent[0]['text']
+        self.assertIn('23', text)
+        self.assertNotIn('22', text)
+        self.assertIn('123', text)
+        self.assertFalse(self.flight.needs_flush())
+
+    def test_coalesce_reverted_change_not_sent(self):
+        tracker.coalesce = 10
+        self.change(gate='22')
+        self.change(gate='')
+        self.flight.flush_notifies(force=True)
+        self.assertEqual(self.sent, [])
+
+    def test_force_flush(self):
+        tracker.coalesce = 10
+        self.change(gate='22')
+        self.flight.flush_notifies()
+        self.assertEqual(self.sent, [])
+        self.flight.flush_notifies(force=True)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_estimate_spam_skipped(self):
+        old = make_flight(est_d=fmt_time(SDT + datetime.timedelta(minutes=10)))
+        close = dict(old, est_d=fmt_time(SDT + datetime.timedelta(minutes=10, seconds=30)))
+        far = dict(old, est_d=fmt_time(SDT + datetime.timedelta(minutes=25)))
+
+        diff = [('change', 'est_d', (old['est_d'], close['est_d']))]
+        self.assertIsNone(self.flight.format_notify(old, close, diff))
+        diff = [('change', 'est_d', (old['est_d'], far['est_d']))]
+        self.assertIsNotNone(self.flight.format_notify(old, far, diff))
+
+    def test_first_estimate_sent(self):
+        new = dict(self.dep, est_d=fmt_time(SDT + datetime.timedelta(seconds=30)))
+        diff = [('change', 'est_d', ('', new['est_d']))]
+        self.assertIsNotNone(self.flight.format_notify(self.dep, new, diff))
+
+
+if __name__ == '__main__':
+    unittest.main()
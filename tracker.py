@@ -4,26 +4,91 @@
 import telegram
 import ledoproxy
 import formatting
+import metrics
+import flights
+import history
 
+import os
+import sys
+import hmac
 import json
 import time
+import signal
+import random
 import threading
 import bottle
+import sqlite3
 import dictdiffer
 import traceback
 import datetime
+import functools
+
+from wsgiref.simple_server import WSGIServer
 
 import logging
-logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(name)s %(message)s')
 logger = logging.getLogger('ledotracker')
 
-with open('config.json', 'r') as f:
-    config = json.loads(f.read())
+# Set up from config.json by setup()
+config = None
+ledoclient = None
+bot = None
+tracker = None
+
+# HTTP server of main(), set once listening
+server = None
+
+# Seconds to collect changes of a flight into one notification
+coalesce = 0
+
+# Keep one edited status message per chat, push new messages only on these fields
+live_cards = False
+live_alerts = ['gate', 'prm']
+
+# Change history, opened when configured
+history_store = None
+
+poll_lag = metrics.Histogram('ledo_tracker_poll_lag_seconds', 'How late flight updates start compared to schedule',
+        buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+
+def load_config(path='config.json'):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+def setup(conf, port):
+    global config, ledoclient, bot, coalesce, live_cards, live_alerts, history_store
+    config = conf
+
+    proxyconf = config['ledoproxy']
+    ledoclient = ledoproxy.ProxyClient(proxyconf['url'], timeout=proxyconf.get('timeout', 10),
+            failures=proxyconf.get('failures', 5), reset=proxyconf.get('reset', 30))
 
+    bot = telegram.Bot(token=config['telegram']['token'], base_url=config['telegram'].get('base_url'))
 
-ledoclient = ledoproxy.ProxyClient(config['ledoproxy']['url'])
+    if config.get('metrics', {}).get('enabled', False):
+        metrics.enable()
 
-bot = telegram.Bot(token=config['telegram']['token'])
+    trackerconf = config.get('ledotracker', {})
+    coalesce = trackerconf.get('coalesce', 0)
+    live_cards = trackerconf.get('live_cards', False)
+    live_alerts = trackerconf.get('live_alerts', ['gate', 'prm'])
+
+    if 'history' in config.keys():
+        # Shards need separate files, use {port} in path
+        path = config['history']['path'].format(port=port)
+        history_store = history.HistoryStore(path, retention=config['history'].get('retention', 180))
+
+def call_api(method, **kwargs):
+    try:
+        with metrics.stage_seconds.time('send'):
+            res = getattr(bot, method)(**kwargs)
+        metrics.telegram_sends.inc(method, 'ok')
+        return res
+    except telegram.error.TelegramError:
+        metrics.telegram_sends.inc(method, 'error')
+        raise
+
+def send_message(**kwargs):
+    return call_api('sendMessage', **kwargs)
 
 class TrackingFailed(Exception):
     pass
@@ -36,140 +101,436 @@ class Tracker(threading.Thread):
         super().__init__()
         self._stopflag = threading.Event()
         self._tracked_flights = {}
+        # Flight codes used by subscribers -> keys of tracked flights
+        self._codes = {}
+        # Leg keys -> key of the tracked flight polling that leg
+        self._legs = {}
+        # Flight codes -> key of flight selected for them without a date
+        self._undated = {}
+        self._next_prune = time.time()
+        # Set when shutting down, no new flights or subscriptions accepted
+        self._draining = False
 
     def run(self):
         while not self._stopflag.wait(timeout=1):
+            if history_store and time.time() >= self._next_prune:
+                self.prune_history()
+
             logger.debug('Checking flights needing updates')
-            for fltnr, flight in list(self._tracked_flights.items()):
+            for key, flight in list(self._tracked_flights.items()):
+                # Finish the update in progress, leave the rest to checkpoint
+                if self._stopflag.is_set():
+                    break
                 if flight.needs_update():
-                    logger.debug('Invoking update for flight %s' % fltnr)
-                    flight.update_status()
+                    logger.debug('Invoking update for flight %s' % key)
+                    poll_lag.observe(time.time() - flight._next_update)
+                    with metrics.stage_seconds.time('update_status'):
+                        flight.update_status()
                     if flight.is_abandoned():
-                        logger.debug('Invoking delete for flight %s' % fltnr)
-                        del self._tracked_flights[fltnr]
+                        logger.debug('Invoking delete for flight %s' % key)
+                        self._forget(key)
+                elif flight.needs_flush():
+                    flight.flush_notifies()
 
 
-    def stop(self):
+    def stop(self, timeout=None):
         self._stopflag.set()
-        self.join()
+        if self.is_alive():
+            self.join(timeout)
         return
 
-    def add_tracker(self, fltnr, user, chan=None, notify=None):
-        if not fltnr in self._tracked_flights.keys():
+    def refuse(self):
+        # No new flights or subscriptions from now on
+        self._draining = True
+
+    def drain(self, timeout=20, state_file=None):
+        logger.info('Draining tracker, %d flights tracked.' % len(self._tracked_flights))
+        self.refuse()
+        until = time.time() + timeout
+        self.stop(timeout)
+        if self.is_alive():
+            logger.error('Flight update still running after %d seconds' % timeout)
+
+        # Send coalesced notifications while time allows, rest stay in checkpoint
+        for key, flight in list(self._tracked_flights.items()):
+            if time.time() >= until:
+                break
             try:
-                flights = ledoclient.get_flight(fltnr)
-            except ledoproxy.NoFlight:
-                raise TrackingFailed('Flight %s not found' % fltnr)
-            except ledoproxy.ConnectionError:
-                raise TrackingFailed('Connection error')
-
-            # Remove flights that are gone
-            flights = [f for f in flights if f['prt'] not in ['Departed', 'Landed', 'Cancelled']]
-            if not flights:
-                raise TrackingFailed('No upcoming flights with code %s' % fltnr)
+                flight.flush_notifies(force=True)
+            except telegram.error.TelegramError as e:
+                logger.error('Could not send pending notifications of %s: %s' % (key, e))
+
+        if state_file:
+            self.checkpoint(state_file)
+
+    def checkpoint(self, path):
+        states = [flight.to_state() for flight in list(self._tracked_flights.values())]
+        if not states:
+            # Older checkpoint must not be restored again
+            if os.path.exists(path):
+                os.remove(path)
+            return
 
-            deps = list(filter(lambda x: not x['arrival'], flights))
-            arrs = list(filter(lambda x: x['arrival'], flights))
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'saved': time.time(), 'flights': states}))
+        os.replace(tmp, path)
+        logger.info('Saved %d flights to %s' % (len(states), path))
+
+    def restore(self, path):
+        # Flights keep their schedule, overdue ones are polled right away.
+        # File stays until next checkpoint, so a crash does not lose them.
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, 'r') as f:
+            states = json.loads(f.read())['flights']
+        for state in states:
+            self.import_flight(state)
+        logger.info('Restored %d flights from %s' % (len(states), path))
+        return len(states)
+
+    def handoff(self, url, attempts=3):
+        # Move all flights to another tracker process and stop polling here.
+        # Flights failing every attempt stay for this port's checkpoint.
+        import requests
+
+        self.refuse()
+        self.stop()
+        headers = {'Content-Type': 'application/json'}
+        token = config.get('ledotracker', {}).get('admin_token')
+        if token:
+            headers['X-Admin-Token'] = token
+
+        moved = 0
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(attempt)
+            for key, flight in list(self._tracked_flights.items()):
+                try:
+                    res = requests.post('%s/import' % url.rstrip('/'), headers=headers,
+                            data=json.dumps({'state': flight.to_state()}), timeout=10)
+                    if res.json()['status'] != 'success':
+                        logger.error('Could not hand off flight %s: %s' % (key, res.json().get('message')))
+                        continue
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    logger.error('Could not hand off flight %s: %s' % (key, e))
+                    continue
+                self._forget(key)
+                moved += 1
+            if not self._tracked_flights:
+                break
 
-            now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-            deps_until = now + datetime.timedelta(hours=24)
-            arrs_until = deps_until
+        logger.info('Handed off %d flights to %s' % (moved, url))
+        return moved
 
-            dep = None
-            arr = None
+    def prune_history(self):
+        self._next_prune = time.time() + 3600
+        try:
+            history_store.prune()
+        except sqlite3.Error as e:
+            logger.error('Could not prune history: %s' % e)
+
+    def _index(self, key, flight):
+        for code in flight._codes:
+            self._codes.setdefault(code, set()).add(key)
+        for leg in flight.leg_keys():
+            self._legs[leg] = key
+
+    def _remember(self, key, flight):
+        self._tracked_flights[key] = flight
+        self._index(key, flight)
+
+    def _forget(self, key):
+        flight = self._tracked_flights.pop(key, None)
+        if not flight:
+            return None
+
+        for code in flight._codes:
+            keys = self._codes.get(code, set())
+            keys.discard(key)
+            if not keys:
+                self._codes.pop(code, None)
+            if self._undated.get(code) == key:
+                self._undated.pop(code)
+        for leg in flight.leg_keys():
+            if self._legs.get(leg) == key:
+                self._legs.pop(leg)
+        return flight
+
+    def _find_leg(self, leg):
+        # Key of tracked flight still polling the leg, if any
+        leg = flights.leg_key(leg)
+        key = self._legs.get(leg)
+        flight = key and self._tracked_flights.get(key)
+        if flight and leg in flight.leg_keys():
+            return key
+        return None
+
+    def _place(self, flight):
+        # Each physical leg is polled once, join the flight polling any of
+        # the legs and hand it the legs nobody polls yet
+        legs = [leg for leg in (flight._dep, flight._arr) if leg]
+        owners = [k for k in (self._find_leg(leg) for leg in legs) if k]
+        if not owners:
+            self._remember(flight._key, flight)
+            return flight._key
+
+        key = owners[0]
+        owner = self._tracked_flights[key]
+        for leg in legs:
+            if not self._find_leg(leg):
+                owner.add_leg(leg)
+        owner.merge_subs(flight)
+        owner._codes.update(flight._codes)
+        self._index(key, owner)
+        return key
+
+    def select_flight(self, fltnr, date=None):
+        try:
+            data = ledoclient.get_flight(fltnr)
+        except ledoproxy.NoFlight:
+            raise TrackingFailed('Flight %s not found' % fltnr)
+        except ledoproxy.ConnectionError:
+            raise TrackingFailed('Connection error')
 
-            if deps:
-                pdep = deps[0]
-                deptime = formatting.parse_time(pdep['sdt'])
-                if deptime < deps_until:
-                    dep = pdep
-                    arrs_until = deptime + datetime.timedelta(hours=24)
+        board = flights.FlightBoard(data)
+        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        dep, arr = flights.select_legs(board, fltnr, now, date=date)
+        if not dep and not arr:
+            raise TrackingFailed('No upcoming flights with code %s' % fltnr)
 
-            if arrs:
-                parr = arrs[0]
-                arrtime = formatting.parse_time(parr['sdt'])
-                if arrtime < arrs_until:
-                    arr = parr
+        return flights.flight_key(dep, arr), dep and dep.data, arr and arr.data
 
-            # If tracking arrival after being departed, wrong departure may track
-            if dep and arr:
-                if formatting.parse_time(dep['sdt']) > formatting.parse_time(arr['sdt']):
-                    dep = None
+    def add_tracker(self, fltnr, user, chan=None, notify=None, date=None, selected=None):
+        if self._draining:
+            raise TrackingFailed('Tracker is restarting, try again in a moment')
 
-            logger.info('Adding flight %s to tracker.' % fltnr)
+        if date:
             try:
-                self._tracked_flights[fltnr] = TrackedFlight(fltnr, dep=dep, arr=arr)
+                date = flights.parse_date(date)
+            except flights.InvalidDate as e:
+                raise TrackingFailed(str(e))
+
+        # Same code without a date goes to the flight selected for it before,
+        # a dated one may be another day
+        key = not date and self._undated.get(fltnr)
+        if not key in self._tracked_flights.keys():
+            # Shard resolving the code may have selected the flight already
+            key, dep, arr = selected or self.select_flight(fltnr, date)
+            try:
+                flight = TrackedFlight(key, (dep or arr)['fltnr'], dep=dep, arr=arr)
+                key = self._place(flight)
+                if self._tracked_flights[key] is flight:
+                    logger.info('Adding flight %s to tracker.' % key)
             except:
                 traceback.print_exc()
                 raise TrackingFailed('General error occurred. See syslog for details.')
+            if not date:
+                self._undated[fltnr] = key
 
-        self._tracked_flights[fltnr].add_sub(user, chan, notify)
+        flight = self._tracked_flights[key]
+        flight.add_sub(user, chan, notify, code=fltnr)
+        flight._codes.add(fltnr)
+        self._codes.setdefault(fltnr, set()).add(key)
 
         return
 
     def del_tracker(self, fltnr, user, chan=None):
-        if not fltnr in self._tracked_flights.keys():
+        keys = [k for k in self._codes.get(fltnr, ()) if k in self._tracked_flights]
+        if not keys:
             raise UntrackingFailed('No tracking started for %s' % fltnr)
 
-        self._tracked_flights[fltnr].del_sub(user, chan)
+        # Several dates may be tracked with same code, pick the one user follows
+        subscribed = [k for k in keys if self._tracked_flights[k].has_sub(user, chan)]
+        key = subscribed and subscribed[0] or keys[0]
+        self._tracked_flights[key].del_sub(user, chan, code=fltnr)
+
+    def resolve(self, fltnr, date=None):
+        # Operating flight number for a code, used for routing to shards.
+        # Selected flight is returned too, so the owner need not fetch it again.
+        if date:
+            try:
+                date = flights.parse_date(date)
+            except flights.InvalidDate as e:
+                raise TrackingFailed(str(e))
+
+        if not date:
+            for key in self._codes.get(fltnr, ()):
+                flight = self._tracked_flights.get(key)
+                if flight:
+                    return flight._fltnr, None
+
+        selected = self.select_flight(fltnr, date)
+        _, dep, arr = selected
+        return (dep or arr)['fltnr'], list(selected)
+
+    def get_flights(self):
+        return [[key, flight._fltnr] for key, flight in list(self._tracked_flights.items())]
+
+    def count_subs(self):
+        return sum(flight.count_subs() for flight in list(self._tracked_flights.values()))
+
+    def max_lag(self):
+        now = time.time()
+        return max([now - f._next_update for f in list(self._tracked_flights.values())] + [0])
+
+    def export_flight(self, key):
+        # Hand flight over to another shard. Flight is no longer polled here.
+        flight = self._forget(key)
+        if not flight:
+            raise UntrackingFailed('No tracking started for %s' % key)
+
+        logger.info('Exporting flight %s from tracker.' % key)
+        return flight.to_state()
+
+    def import_flight(self, state):
+        if self._draining:
+            raise TrackingFailed('Tracker is restarting, try again in a moment')
+
+        flight = TrackedFlight.from_state(state)
+        key = flight._key
+        if key in self._tracked_flights.keys():
+            self._tracked_flights[key].merge_subs(flight)
+            self._tracked_flights[key]._codes.update(flight._codes)
+            self._index(key, self._tracked_flights[key])
+        else:
+            logger.info('Importing flight %s to tracker.' % key)
+            self._place(flight)
 
 
 
 class TrackedFlight(object):
-    def __init__(self, fltnr, dep, arr):
+    def __init__(self, key, fltnr, dep, arr):
+        self._key = key
+        # Operating flight number used for polling
         self._fltnr = fltnr
+        self._codes = set()
         self._dep = dep
         self._arr = arr
+        # Subscribers with the flight code they used
         self._priv_subs = []
         self._chan_subs = {}
+        # Coalesced changes per leg: [state before first change, latest state, deadline]
+        self._pending = {}
+        # Live cards per chat: [message id, rendered text]
+        self._cards = {}
 
 
         self.set_next_update()
 
+    def to_state(self):
+        return {
+                'key': self._key,
+                'fltnr': self._fltnr,
+                'codes': list(self._codes),
+                'dep': self._dep,
+                'arr': self._arr,
+                'priv_subs': [list(s) for s in self._priv_subs],
+                # Channel IDs are ints, JSON object keys would turn them to str
+                'chan_subs': [[chan, [list(s) for s in users]] for chan, users in self._chan_subs.items()],
+                'pending': [[leg] + list(p) for leg, p in self._pending.items()],
+                'cards': [[chat] + list(c) for chat, c in self._cards.items()],
+                'next_update': self._next_update
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        flight = cls(state['key'], state['fltnr'], dep=state['dep'], arr=state['arr'])
+        flight._codes = set(state['codes'])
+        flight._priv_subs = [tuple(s) for s in state['priv_subs']]
+        flight._chan_subs = dict((chan, [tuple(s) for s in users]) for chan, users in state['chan_subs'])
+        flight._pending = dict((p[0], list(p[1:])) for p in state.get('pending', []))
+        flight._cards = dict((c[0], list(c[1:])) for c in state.get('cards', []))
+        flight._next_update = state.get('next_update', flight._next_update)
+        return flight
+
+    def leg_keys(self):
+        return [flights.leg_key(leg) for leg in (self._dep, self._arr) if leg]
+
+    def add_leg(self, leg):
+        # Only fills a missing direction, a leg replacing another is left out
+        if leg['arrival'] and not self._arr:
+            self._arr = leg
+        elif not leg['arrival'] and not self._dep:
+            self._dep = leg
+
+    def merge_subs(self, other):
+        known = [u for u, _ in self._priv_subs]
+        for user, code in other._priv_subs:
+            if not user in known:
+                self._priv_subs.append((user, code))
+
+        for chan, users in other._chan_subs.items():
+            if not chan in self._chan_subs.keys():
+                self._chan_subs[chan] = []
+            known = [u for u, _, _ in self._chan_subs[chan]]
+            for user, notify, code in users:
+                if not user in known:
+                    self._chan_subs[chan].append((user, notify, code))
+
+        for chat, card in other._cards.items():
+            if not chat in self._cards:
+                self._cards[chat] = card
+
     def needs_update(self):
         return time.time() >= self._next_update
 
     def update_status(self):
         try:
-            flights = ledoclient.get_flight(self._fltnr)
+            data = ledoclient.get_flight(self._fltnr)
         except ledoproxy.NoFlight:
             logger.info('Flight %s disppeared. Cleaning..' % self._fltnr)
+            self.flush_notifies(force=True)
             self._priv_subs = []
             self._chan_subs = {}
             return
+        except ledoproxy.CircuitOpen:
+            # Spread retries so recovering proxy is not hit by every flight at once
+            logger.debug('Proxy unavailable. Skipping this round for %s' % self._fltnr)
+            self._next_update = time.time() + random.uniform(1, 30)
+            return
         except ledoproxy.ConnectionError:
             logger.error('Could not get flight status. Skipping this round for %s' % self._fltnr)
             return
 
 
         if self._dep:
-            deps = [f for f in flights if f['sdate'] == self._dep['sdate'] and not f['arrival']]
+            key = flights.leg_key(self._dep)
+            deps = [f for f in data if flights.leg_key(f) == key]
             if deps:
                 dep = deps[0]
-                diff = list(dictdiffer.diff(self._dep, dep))
+                with metrics.stage_seconds.time('diff'):
+                    diff = list(dictdiffer.diff(self._dep, dep))
                 if diff:
-                    self.send_notifies(self._dep, dep, diff)
-                    self._dep = dep
+                    self.record_history(dep, diff)
+                    old, self._dep = self._dep, dep
+                    self.notify_change('dep', old, dep, diff)
             else:
                 self._dep = None
 
         if self._arr:
-            arrs = [f for f in flights if f['sdate'] == self._arr['sdate'] and f['arrival']]
+            key = flights.leg_key(self._arr)
+            arrs = [f for f in data if flights.leg_key(f) == key]
             if arrs:
                 arr = arrs[0]
-                diff = list(dictdiffer.diff(self._arr, arr))
+                with metrics.stage_seconds.time('diff'):
+                    diff = list(dictdiffer.diff(self._arr, arr))
                 if diff:
-                    self.send_notifies(self._arr, arr, diff)
-                    self._arr = arr
+                    self.record_history(arr, diff)
+                    old, self._arr = self._arr, arr
+                    self.notify_change('arr', old, arr, diff)
             else:
                 self._arr = None
 
         if not self._dep and not self._arr:
             logger.info('Flight %s completed. Cleaning..' % self._fltnr)
+            self.flush_notifies(force=True)
             self._priv_subs = []
             self._chan_subs = {}
             return
 
+        self.flush_notifies()
         self.set_next_update()
         return
 
@@ -177,7 +538,78 @@ class TrackedFlight(object):
         self._next_update = time.time() + 30
         return
 
+    def record_history(self, new, diff):
+        if not history_store:
+            return
+        try:
+            with metrics.stage_seconds.time('history'):
+                history_store.record(new, diff)
+        except sqlite3.Error as e:
+            logger.error('Could not record history for %s: %s' % (self._fltnr, e))
+
+    def notify_change(self, leg, old, new, diff):
+        if not coalesce:
+            self.send_notifies(old, new, diff)
+            return
+
+        if leg in self._pending:
+            self._pending[leg][1] = new
+        else:
+            self._pending[leg] = [old, new, time.time() + coalesce]
+
+    def needs_flush(self):
+        now = time.time()
+        return any(deadline <= now for _, _, deadline in self._pending.values())
+
+    def flush_notifies(self, force=False):
+        # Diff against state before the first change gives latest value per field
+        now = time.time()
+        for leg, (old, new, deadline) in list(self._pending.items()):
+            if deadline > now and not force:
+                continue
+            del self._pending[leg]
+            with metrics.stage_seconds.time('diff'):
+                diff = list(dictdiffer.diff(old, new))
+            if diff:
+                self.send_notifies(old, new, diff)
+
     def send_notifies(self, old, new, diff):
+        fields = None
+        if live_cards:
+            self.update_cards()
+            fields = live_alerts
+
+        # Render once per flight code in use, not once per subscriber
+        texts = {}
+        def text_for(code):
+            if not code in texts:
+                with metrics.stage_seconds.time('format'):
+                    texts[code] = self.format_notify(old, new, diff, code, fields)
+            return texts[code]
+
+        for user, code in self._priv_subs:
+            text = text_for(code)
+            if text:
+                self.send_notify(user, text)
+
+        for chan, users in self._chan_subs.items():
+            by_code = {}
+            for user, notify, code in users:
+                by_code.setdefault(code, []).append((user, notify))
+
+            for code, code_users in by_code.items():
+                text = text_for(code)
+                if not text:
+                    continue
+                to_notify = []
+                for user, notify in code_users:
+                    notstr = '[%s](tg://user?id=%s)' % (notify, user)
+                    to_notify.append(notstr)
+                notify_row = ' '.join(to_notify)
+                ctext = '%s\n%s' % (notify_row, text)
+                self.send_notify(chan, ctext)
+
+    def format_notify(self, old, new, diff, code=None, fields=None):
         interesting = {
                 'aircraft': 'fmt_aircraft',
                 'acreg': 'fmt_aircraft',
@@ -189,8 +621,8 @@ class TrackedFlight(object):
                 'bltarea': 'fmt_belt'
         }
 
-        fmt_o = formatting.FinaviaFormatter(old)
-        fmt_n = formatting.FinaviaFormatter(new)
+        fmt_o = formatting.FinaviaFormatter(old, code=code)
+        fmt_n = formatting.FinaviaFormatter(new, code=code)
         to_send = False
         lines = []
         lines.append(fmt_o.fmt_name())
@@ -204,6 +636,8 @@ class TrackedFlight(object):
                 continue
             if not cvalue in interesting.keys():
                 continue
+            if fields is not None and not cvalue in fields:
+                continue
             if cvalue == 'est_d' and old['est_d'] and new['est_d']:
                 oldtime = formatting.parse_time(old['est_d'])
                 newtime = formatting.parse_time(new['est_d'])
@@ -220,67 +654,145 @@ class TrackedFlight(object):
                 continue
 
         if to_send:
-            text = '\n'.join(lines)
-            for user in self._priv_subs:
-                self.send_notify(user, text)
-
-            for chan, users in self._chan_subs.items():
-                to_notify = []
-                for user, notify in users:
-                    notstr = '[%s](tg://user?id=%s)' % (notify, user)
-                    to_notify.append(notstr)
-                notify_row = ' '.join(to_notify)
-                ctext = '%s\n%s' % (notify_row, text)
-                self.send_notify(chan, ctext)
+            return '\n'.join(lines)
+        return None
 
     def send_notify(self, chatid, text):
-        bot.sendMessage(chat_id=chatid, text=text, parse_mode='Markdown')
+        send_message(chat_id=chatid, text=text, parse_mode='Markdown')
+
+    def card_chats(self):
+        chats = [(user, code) for user, code in self._priv_subs]
+        chats += [(chan, users[0][2]) for chan, users in self._chan_subs.items() if users]
+        return chats
+
+    def render_card(self, code):
+        parts = []
+        for leg in (self._dep, self._arr):
+            if leg:
+                parts.append(formatting.FinaviaFormatter(leg, code=code).to_text())
+        return '\n\n'.join(parts)
+
+    def update_cards(self):
+        texts = {}
+        for chat, code in self.card_chats():
+            if not code in texts:
+                with metrics.stage_seconds.time('format'):
+                    texts[code] = self.render_card(code)
+            text = texts[code]
+
+            # Only touch messages whose rendering actually changed
+            card = self._cards.get(chat)
+            if not text or card and card[1] == text:
+                continue
+            self._cards[chat] = self.send_card(chat, text, card and card[0])
+
+    def send_card(self, chat, text, message_id=None):
+        if message_id:
+            try:
+                call_api('editMessageText', chat_id=chat, message_id=message_id, text=text, parse_mode='Markdown')
+                return [message_id, text]
+            except telegram.error.TelegramError as e:
+                logger.info('Could not edit card of %s in %s, sending new: %s' % (self._fltnr, chat, e))
+
+        try:
+            msg = send_message(chat_id=chat, text=text, parse_mode='Markdown')
+        except telegram.error.TelegramError as e:
+            logger.error('Could not send card of %s to %s: %s' % (self._fltnr, chat, e))
+            return [message_id, None]
+
+        try:
+            call_api('pinChatMessage', chat_id=chat, message_id=msg.message_id, disable_notification=True)
+        except telegram.error.TelegramError:
+            # Not allowed to pin in groups without admin rights
+            pass
+
+        return [msg.message_id, text]
 
     def is_abandoned(self):
         return not self._priv_subs and not self._chan_subs
 
-    def add_sub(self, user, chan=None, notify=None):
+    def has_sub(self, user, chan=None):
+        if not chan:
+            return user in [u for u, _ in self._priv_subs]
+        return user in [u for u, _, _ in self._chan_subs.get(chan, [])]
+
+    def count_subs(self):
+        return len(self._priv_subs) + sum(len(users) for users in self._chan_subs.values())
+
+    def add_sub(self, user, chan=None, notify=None, code=None):
+        if not code:
+            code = self._fltnr
+
         if not chan:
-            if user in self._priv_subs:
-                raise TrackingFailed('You are already tracking flight %s' % self._fltnr)
+            if self.has_sub(user):
+                raise TrackingFailed('You are already tracking flight %s' % code)
             else:
-                self._priv_subs.append(user)
+                self._priv_subs.append((user, code))
+
+                if live_cards:
+                    self.update_cards()
+                    return
 
                 # Send initial flight info when used privately
                 if self._dep:
-                    fmt = formatting.FinaviaFormatter(self._dep)
-                    bot.sendMessage(chat_id=user, text=fmt.to_text(), parse_mode='Markdown')
+                    fmt = formatting.FinaviaFormatter(self._dep, code=code)
+                    send_message(chat_id=user, text=fmt.to_text(), parse_mode='Markdown')
 
                 if self._arr:
-                    fmt = formatting.FinaviaFormatter(self._arr)
-                    bot.sendMessage(chat_id=user, text=fmt.to_text(), parse_mode='Markdown')
+                    fmt = formatting.FinaviaFormatter(self._arr, code=code)
+                    send_message(chat_id=user, text=fmt.to_text(), parse_mode='Markdown')
 
         else:
-            if not chan in self._chan_subs.keys():
-                self._chan_subs[chan] = []
-            if user in map(lambda x:x[0], self._chan_subs[chan]):
-                raise TrackingFailed('You are already tracking flight %s' % self._fltnr)
+            if self.has_sub(user, chan):
+                raise TrackingFailed('You are already tracking flight %s' % code)
             else:
-                self._chan_subs[chan].append((user, notify))
+                if not chan in self._chan_subs.keys():
+                    self._chan_subs[chan] = []
+                self._chan_subs[chan].append((user, notify, code))
+
+                if live_cards:
+                    self.update_cards()
+
+    def del_sub(self, user, chan=None, code=None):
+        if not code:
+            code = self._fltnr
 
-    def del_sub(self, user, chan=None):
         if not chan:
-            if not user in self._priv_subs:
-                raise UntrackingFailed('You are not tracking flight %s' % self._fltnr)
+            userlist = [u for u, _ in self._priv_subs]
+            if not user in userlist:
+                raise UntrackingFailed('You are not tracking flight %s' % code)
             else:
-                del self._priv_subs[self._priv_subs.index(user)]
+                del self._priv_subs[userlist.index(user)]
+                self._cards.pop(user, None)
 
         else:
             if not chan in self._chan_subs.keys():
-                raise UntrackingFailed('Flight %s not being tracked in this channel' % self._fltnr)
-            userlist = list(map(lambda x:x[0], self._chan_subs[chan]))
+                raise UntrackingFailed('Flight %s not being tracked in this channel' % code)
+            userlist = [u for u, _, _ in self._chan_subs[chan]]
             if not user in userlist:
-                raise UntrackingFailed('You are not tracking flight %s in this channel' % self._fltnr)
+                raise UntrackingFailed('You are not tracking flight %s in this channel' % code)
 
             del self._chan_subs[chan][userlist.index(user)]
 
             if not self._chan_subs[chan]:
                 del self._chan_subs[chan]
+                self._cards.pop(chan, None)
+
+
+def admin(func):
+    # Routes moving subscriber state between processes. With admin_token in
+    # config callers must send it, without one only local callers are let in.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = config.get('ledotracker', {}).get('admin_token')
+        if token:
+            allowed = hmac.compare_digest(bottle.request.get_header('X-Admin-Token', ''), token)
+        else:
+            allowed = bottle.request.remote_addr in ('127.0.0.1', '::1')
+        if not allowed:
+            return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Not allowed'}), status=403)
+        return func(*args, **kwargs)
+    return wrapper
 
 
 @bottle.route('/track', method='POST')
@@ -296,19 +808,34 @@ def r_track():
         if not 'notify' in payload.keys():
             return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Notify name is mandatory when using channel'}), status=500)
         try:
-            tracker.add_tracker(payload['fltnr'], payload['user'], chan=payload['chan'], notify=payload['notify'])
+            tracker.add_tracker(payload['fltnr'], payload['user'], chan=payload['chan'], notify=payload['notify'], date=payload.get('date'),
+                    selected=payload.get('selected'))
             return bottle.HTTPResponse(json.dumps({'status': 'success', 'message': 'Tracker added'}))
         except TrackingFailed as e:
             return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
 
     else:
         try:
-            tracker.add_tracker(payload['fltnr'], (payload['user']))
+            tracker.add_tracker(payload['fltnr'], (payload['user']), date=payload.get('date'), selected=payload.get('selected'))
             return bottle.HTTPResponse(json.dumps({'status': 'success', 'message': 'Tracker added'}))
         except TrackingFailed as e:
             return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
 
 
+@bottle.route('/resolve', method='POST')
+def r_resolve():
+    payload = bottle.request.json
+
+    if not 'fltnr' in payload.keys():
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Flight number is mandatory'}), status=500)
+
+    try:
+        fltnr, selected = tracker.resolve(payload['fltnr'], date=payload.get('date'))
+        return bottle.HTTPResponse(json.dumps({'status': 'success', 'fltnr': fltnr, 'selected': selected}))
+    except TrackingFailed as e:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
+
+
 @bottle.route('/untrack', method='POST')
 def r_untrack():
     payload = bottle.request.json
@@ -325,20 +852,167 @@ def r_untrack():
         return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
 
 
+@bottle.route('/metrics', method='GET')
+def r_metrics():
+    if not metrics.enabled:
+        return bottle.HTTPResponse('Metrics disabled\n', status=404)
+    return bottle.HTTPResponse(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@bottle.route('/history/<fltnr>', method='GET')
+def r_history(fltnr):
+    if not history_store:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'History not enabled'}), status=500)
+
+    try:
+        days = float(bottle.request.query.get('days') or 30)
+        limit = int(bottle.request.query.get('limit') or 100)
+    except ValueError:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Invalid query'}), status=500)
+
+    events = history_store.timeline(fltnr, since=time.time() - days * 86400, limit=limit)
+    return bottle.HTTPResponse(json.dumps({'status': 'success', 'events': events}))
+
+
+@bottle.route('/delays', method='GET')
+def r_delays():
+    if not history_store:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'History not enabled'}), status=500)
+
+    try:
+        days = float(bottle.request.query.get('days') or 30)
+        delays = history_store.delays(by=bottle.request.query.get('by') or 'airline', since=time.time() - days * 86400)
+    except ValueError as e:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
+
+    return bottle.HTTPResponse(json.dumps({'status': 'success', 'delays': delays}))
+
+
+@bottle.route('/flights', method='GET')
+def r_flights():
+    return bottle.HTTPResponse(json.dumps({'status': 'success', 'flights': tracker.get_flights()}))
+
+
+@bottle.route('/export', method='POST')
+@admin
+def r_export():
+    payload = bottle.request.json
+
+    if not 'key' in payload.keys():
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Flight key is mandatory'}), status=500)
+
+    try:
+        state = tracker.export_flight(payload['key'])
+        return bottle.HTTPResponse(json.dumps({'status': 'success', 'state': state}))
+    except UntrackingFailed as e:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
+
+
+@bottle.route('/import', method='POST')
+@admin
+def r_import():
+    payload = bottle.request.json
+
+    if not 'state' in payload.keys():
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Flight state is mandatory'}), status=500)
+
+    try:
+        tracker.import_flight(payload['state'])
+        return bottle.HTTPResponse(json.dumps({'status': 'success', 'message': 'Flight imported'}))
+    except TrackingFailed as e:
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': str(e)}), status=500)
+    except (KeyError, TypeError):
+        traceback.print_exc()
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Invalid flight state'}), status=500)
+
+
+@bottle.route('/handoff', method='POST')
+@admin
+def r_handoff():
+    payload = bottle.request.json
+
+    if not 'url' in payload.keys():
+        return bottle.HTTPResponse(json.dumps({'status': 'error', 'message': 'Target URL is mandatory'}), status=500)
+
+    # Shards are found by URL, so the new process must take over this
+    # tracker's address (e.g. behind a reverse proxy) once this one exits
+    moved = tracker.handoff(payload['url'])
+    left = len(tracker.get_flights())
+
+    # Shut down after answering. Flights not moved are saved to this port's
+    # state_file; starting a tracker on this port again restores them so
+    # they can be handed off once more.
+    threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    return bottle.HTTPResponse(json.dumps({'status': 'success', 'moved': moved, 'left': left}))
+
+
+class Server(WSGIServer):
+    # Requests are served one at a time, let bursts of clients queue up
+    # instead of being reset once the default backlog of 5 is full
+    request_queue_size = 128
+
+    # Remembered so SIGTERM can stop serving between requests
+    def server_activate(self):
+        global server
+        super().server_activate()
+        server = self
+
+
+def shutdown(signum, frame):
+    # Only ask the server loop to exit, request in progress is finished first
+    # and drain() runs undisturbed by further signals
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tracker.refuse()
+
+    if not server:
+        # Not serving yet, bottle.run returns on KeyboardInterrupt
+        raise KeyboardInterrupt
+    threading.Thread(target=server.shutdown).start()
+
+
 def add_all():
-    flights = ledoclient.get_flights()
-    for fltnr in flights:
+    fltnrs = ledoclient.get_flights()
+    for fltnr in fltnrs:
         try:
             # Channel as user :D For spam :D
             tracker.add_tracker(fltnr, config['telegram']['testchan'], None)
         except TrackingFailed as e:
             print(e)
 
-if __name__ == '__main__':
+def main():
+    global tracker
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(name)s %(message)s')
+
+    # Port can be given on command line to run several tracker shards on one host
+    conf = load_config()
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    else:
+        port = conf.get('ledotracker', {}).get('port', 8421)
+    setup(conf, port)
+
+    trackerconf = conf.get('ledotracker', {})
+    state_file = trackerconf.get('state_file')
+    if state_file:
+        state_file = state_file.format(port=port)
+
+    tracker = Tracker()
+    if state_file:
+        tracker.restore(state_file)
+
+    metrics.Gauge('ledo_tracker_flights', 'Tracked flights', func=lambda: len(tracker.get_flights()))
+    metrics.Gauge('ledo_tracker_subscribers', 'Subscriptions over all tracked flights', func=tracker.count_subs)
+    metrics.Gauge('ledo_tracker_poll_lag_max_seconds', 'Largest delay of a pending flight update', func=tracker.max_lag)
+    metrics.Gauge('ledo_proxy_circuit_open', 'Proxy circuit breaker is open', func=lambda: int(not ledoclient.is_available()))
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
     try:
-        tracker = Tracker()
         #add_all()
         tracker.start()
-        bottle.run(host='0.0.0.0', port=8421)
+        bottle.run(host='0.0.0.0', port=port, server_class=Server)
     finally:
-        tracker.stop()
+        tracker.drain(timeout=trackerconf.get('drain_timeout', 20), state_file=state_file)
+
+if __name__ == '__main__':
+    main()